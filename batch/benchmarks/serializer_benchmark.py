@@ -0,0 +1,100 @@
+"""Micro-benchmark of the catalog backup serializers on a synthetic catalog.
+
+Encodes the partitions of a synthetic catalog to tsv lines, as extract_database does, and decodes them back, as
+restore_data does, once with the line format of the original job and once per serializer of catalog_serializer.
+
+    python batch/benchmarks/serializer_benchmark.py --partitions 1000000
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'script'))
+from catalog_serializer import get_serializer, orjson
+
+
+def get_partition(table_index, partition_index, column_count):
+    day = datetime.date(2020, 1, 1) + datetime.timedelta(days=partition_index % 1000)
+    return {
+        'Values': [day.isoformat(), str(partition_index % 24)],
+        'StorageDescriptor': {
+            'Columns': [{'Name': f"column_{column}", 'Type': 'string' if column % 3 else 'bigint'} for column in range(column_count)],
+            'Location': f"s3://benchmark-bucket/warehouse/table_{table_index}/dt={day.isoformat()}/hour={partition_index % 24}",
+            'InputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
+            'OutputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat',
+            'Compressed': False,
+            'NumberOfBuckets': -1,
+            'SerdeInfo': {'SerializationLibrary': 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe',
+                          'Parameters': {'serialization.format': '1'}},
+            'StoredAsSubDirectories': False,
+        },
+        'Parameters': {'numRows': str(partition_index * 17), 'totalSize': str(partition_index * 4096)},
+    }
+
+
+def get_page(table_index, page_size, column_count):
+    """One GetPartitions page of records, the unit extract_database hands to CatalogWriter.write."""
+    return [('partition', 'benchmark_db', f"table_{table_index}", get_partition(table_index, partition_index, column_count))
+            for partition_index in range(page_size)]
+
+
+def encode_legacy(records):
+    return ''.join(f"{object_type}\t{db_name}\t{object_name}\t{json.dumps(data)}\n"
+                   for object_type, db_name, object_name, data in records).encode('utf-8')
+
+
+def decode_legacy(line):
+    object_type, db_name, object_name, object_data = line.decode('utf-8').split("\t")
+    return object_type, db_name, object_name, json.loads(object_data)
+
+
+def run(name, encode, decode, pages):
+    encoded_size = 0
+    encode_time = decode_time = 0.0
+    for page in pages:
+        start = time.perf_counter()
+        data = encode(page)
+        encode_time += time.perf_counter() - start
+        encoded_size += len(data)
+        lines = data.split(b'\n')[:-1]
+        start = time.perf_counter()
+        for line in lines:
+            decode(line)
+        decode_time += time.perf_counter() - start
+    return name, encode_time, decode_time, encoded_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--partitions', type=int, default=1000000, help='partitions of the synthetic catalog')
+    parser.add_argument('--page-size', type=int, default=1000, help='partitions per GetPartitions page')
+    parser.add_argument('--columns', type=int, default=12, help='columns per partition storage descriptor')
+    parser.add_argument('--distinct-pages', type=int, default=20,
+                        help='distinct pages generated and cycled through, keeps the generator out of the timings')
+    args = parser.parse_args()
+
+    page_count = max(args.partitions // args.page_size, 1)
+    distinct_pages = [get_page(table_index, args.page_size, args.columns) for table_index in range(min(args.distinct_pages, page_count))]
+    pages = [distinct_pages[page_index % len(distinct_pages)] for page_index in range(page_count)]
+    print(f"Synthetic catalog of {page_count * args.page_size} partitions in pages of {args.page_size}")
+
+    results = [run('legacy', encode_legacy, decode_legacy, pages)]
+    serializers = ['json', 'orjson'] if orjson is not None else ['json']
+    for serializer_name in serializers:
+        serializer = get_serializer(serializer_name)
+        results.append(run(serializer_name, serializer.encode_tsv, serializer.decode_tsv, pages))
+    if orjson is None:
+        print("orjson is not installed, only the standard library backend is measured")
+
+    legacy_total = results[0][1] + results[0][2]
+    print(f"{'backend':<10}{'encode s':>10}{'decode s':>10}{'total s':>10}{'MB':>10}{'speedup':>10}")
+    for name, encode_time, decode_time, encoded_size in results:
+        total = encode_time + decode_time
+        print(f"{name:<10}{encode_time:>10.2f}{decode_time:>10.2f}{total:>10.2f}{encoded_size / 2 ** 20:>10.0f}{legacy_total / total:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,55 @@ import os
 import sys
 import boto3
 import botocore
+import botocore.config
 import json
+import hashlib
 import awswrangler as wr
-import tempfile
+import pandas as pd
+import gzip
+import io
 import time
+import datetime
 import ast
+import threading
+import itertools
+import random
 from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
 from configparser import ConfigParser
-from urllib.parse import urlparse, urlunparse
+from urllib.parse import urlparse
 from awsglue.utils import getResolvedOptions
+from catalog_serializer import (CatalogRecord, decode_partition_delta, encode_partition_delta, get_permission_changes,
+                                get_permission_entries, get_permission_keys, get_serializer)
+from catalog_remapper import LocationMapper, get_catalog_remapper
 
-information_schema_name = "information_schema"
-df_index = ['table_schema', 'table_name']
+database_keys_to_be_removed = ['CreateTime', 'CatalogId','VersionId']
+table_keys_to_be_removed = ['CatalogId','DatabaseName','LastAccessTime','CreateTime', 'UpdateTime', 'CreatedBy','IsRegisteredWithLakeFormation','VersionId']
+data_cells_filter_keys_to_be_removed = ['TableCatalogId','VersionId']
+partition_keys_to_be_removed = ['CatalogId', 'DatabaseName', 'CreationTime', 'LastAccessTime']
+
+# Size of the parts streamed to S3, multipart uploads need at least 5 MB per part
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+BACKUP_FORMATS = ['tsv', 'jsonl.gz', 'jsonl.zst', 'parquet']
+# Rows buffered before a parquet file is written to the backup dataset
+PARQUET_ROWS_PER_FILE = 100000
+# Upper limit of partitions accepted by a single BatchCreatePartition/BatchUpdatePartition call
+PARTITION_BATCH_SIZE = 100
+# Upper limits of BatchDeleteTable and BatchDeletePartition
+TABLE_DELETE_BATCH_SIZE = 100
+PARTITION_DELETE_BATCH_SIZE = 25
+# Upper limit of entries accepted by a single BatchGrantPermissions/BatchRevokePermissions call
+PERMISSION_BATCH_SIZE = 20
+# Entry errors of BatchGrantPermissions/BatchRevokePermissions that are worth retrying
+PERMISSION_RETRY_ERROR_CODES = {'ConcurrentModificationException', 'ThrottlingException', 'InternalServiceException'}
+# Upper limit of values accepted by a single UpdateLFTag call
+LF_TAG_VALUE_BATCH_SIZE = 50
+# list_permissions resource types holding the grants on LF-Tags and LF-Tag expressions
+LF_TAG_PERMISSION_RESOURCE_TYPES = ['LF_TAG', 'LF_TAG_POLICY_DATABASE', 'LF_TAG_POLICY_TABLE']
+# Seconds between two checkpoint writes and records between two checkpoint checks of the restore
+CHECKPOINT_INTERVAL = 30
+CHECKPOINT_RECORD_INTERVAL = 1000
 
 def get_config(s3_config_bucket,s3_config_file ):
     s3 = boto3.client('s3')
@@ -23,21 +60,205 @@ def get_config(s3_config_bucket,s3_config_file ):
     return config
 
 
-def get_client(region_name, service):
+def get_client(region_name, service, max_pool_connections=10, max_attempts=10):
+    # Adaptive retries give every thread sharing this client one throttling-aware retry budget
     session = boto3.Session(region_name=region_name)
-    return session.client(service)
+    client_config = botocore.config.Config(max_pool_connections=max_pool_connections,
+                                           retries={'max_attempts': max_attempts, 'mode': 'adaptive'})
+    return session.client(service, config=client_config)
+
+def split_s3_path(s3_path):
+    u = urlparse(s3_path)
+    return u.netloc, u.path.lstrip('/')
+
+class S3StreamWriter:
+    """Thread-safe writer that uploads an S3 object part by part while it is still being written.
+
+    Objects smaller than one part are stored with a single PutObject when the writer is closed."""
+
+    def __init__(self, s3_client, s3_path, part_size=MULTIPART_PART_SIZE):
+        self.s3_client = s3_client
+        self.s3_path = s3_path
+        self.bucket, self.key = split_s3_path(s3_path)
+        self.part_size = part_size
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._part_number = 0
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        with self._lock:
+            self._buffer += data
+            if len(self._buffer) < self.part_size:
+                return len(data)
+            part_number, body = self._take_part()
+        # The part is sent outside of the lock so that other threads can keep filling the next one
+        self._upload_part(part_number, body)
+        return len(data)
+
+    def flush(self):
+        # Parts are only sent once they are full, close() uploads whatever is left
+        pass
+
+    def _take_part(self):
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        self._part_number += 1
+        body = bytes(self._buffer)
+        self._buffer = bytearray()
+        return self._part_number, body
+
+    def _upload_part(self, part_number, body):
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              PartNumber=part_number, Body=body)
+        with self._lock:
+            self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self._upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            return
+        if self._buffer:
+            self._upload_part(*self._take_part())
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                 MultipartUpload={'Parts': sorted(self._parts, key=lambda p: p['PartNumber'])})
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+def read_s3_lines(s3_client, s3_path, compression=None, decode=True):
+    """Yields the non-empty lines of an S3 object, as bytes when decode is False."""
+    bucket, key = split_s3_path(s3_path)
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    if compression is None:
+        for line in body.iter_lines(chunk_size=MULTIPART_PART_SIZE):
+            if line:
+                yield line.decode('utf-8') if decode else line
+        return
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=body, mode='rb')
+    else:
+        stream = io.BufferedReader(get_zstandard().ZstdDecompressor().stream_reader(body), MULTIPART_PART_SIZE)
+    if decode:
+        stream = io.TextIOWrapper(stream, encoding='utf-8')
+    for line in stream:
+        if line.strip():
+            yield line
+
+def get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("backup_format jsonl.zst needs the zstandard module, add it to the --additional-python-modules job argument")
+    return zstandard
+
+class CatalogWriter:
+    """Writes (object_type, database, name, data) records to the catalog backup in the configured backup_format.
+
+    tsv keeps the original object_type<TAB>database<TAB>name<TAB>json lines, jsonl.gz and jsonl.zst store one compressed
+    JSON document per record and parquet writes a dataset partitioned by object_type and database below s3_path."""
 
+    def __init__(self, s3_client, s3_path, backup_format='tsv', serializer=None):
+        if backup_format not in BACKUP_FORMATS:
+            raise ValueError(f"Unsupported backup_format {backup_format}, expected one of {BACKUP_FORMATS}")
+        self.backup_format = backup_format
+        self.serializer = serializer or get_serializer()
+        self.s3_path = s3_path
+        self._lock = threading.Lock()
+        self._rows = []
+        self._stream = None
+        self._compressor = None
+        if backup_format == 'parquet':
+            self.s3_path = s3_path.rstrip('/') + '/'
+            wr.s3.delete_objects(self.s3_path)
+            return
+        self._stream = S3StreamWriter(s3_client, s3_path)
+        if backup_format == 'jsonl.gz':
+            self._compressor = gzip.GzipFile(fileobj=self._stream, mode='wb')
+        elif backup_format == 'jsonl.zst':
+            self._compressor = get_zstandard().ZstdCompressor().stream_writer(self._stream, closefd=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._stream is not None:
+            self._stream.abort()
+
+    def write(self, records):
+        if self.backup_format == 'parquet':
+            with self._lock:
+                self._rows.extend(records)
+                if len(self._rows) < PARQUET_ROWS_PER_FILE:
+                    return
+                rows, self._rows = self._rows, []
+            self._write_parquet(rows)
+        elif self.backup_format == 'tsv':
+            self._stream.write(self.serializer.encode_tsv(records))
+        else:
+            data = self.serializer.encode_jsonl(records)
+            # Compressors are not thread-safe, the compressed bytes are still streamed part by part
+            with self._lock:
+                self._compressor.write(data)
+
+    def _write_parquet(self, rows):
+        df = pd.DataFrame([(object_type, db_name, object_name, self.serializer.dumps(data).decode('utf-8'))
+                           for object_type, db_name, object_name, data in rows],
+                          columns=['object_type', 'database', 'name', 'data'])
+        wr.s3.to_parquet(df, path=self.s3_path, dataset=True, mode='append', partition_cols=['object_type', 'database'])
+
+    def close(self):
+        if self.backup_format == 'parquet':
+            if self._rows:
+                self._write_parquet(self._rows)
+                self._rows = []
+            return
+        if self._compressor is not None:
+            self._compressor.close()
+        self._stream.close()
+
+def read_catalog_records(s3_client, s3_path, backup_format='tsv', db_list=None, serializer=None):
+    """Yields the CatalogRecords of the catalog backup, limited to db_list when it is given."""
+    if backup_format not in BACKUP_FORMATS:
+        raise ValueError(f"Unsupported backup_format {backup_format}, expected one of {BACKUP_FORMATS}")
+    serializer = serializer or get_serializer()
+    if backup_format == 'parquet':
+        # Reading one object type at a time keeps databases ahead of tables and tables ahead of partitions, and the
+        # partition filter only lists the database prefixes that are needed
+        for object_type in ['database', 'table', 'partition']:
+            dfs = wr.s3.read_parquet(path=s3_path.rstrip('/') + '/', dataset=True, chunked=True,
+                                     partition_filter=lambda p, t=object_type: p['object_type'] == t and (db_list is None or p['database'] in db_list))
+            for df in dfs:
+                for db_name, object_name, data in zip(df['database'], df['name'], df['data']):
+                    yield CatalogRecord(object_type, db_name, object_name, serializer.loads(data))
+        return
+    if backup_format == 'tsv':
+        lines, decode_line = read_s3_lines(s3_client, s3_path, decode=False), serializer.decode_tsv
+    else:
+        compression = 'gzip' if backup_format == 'jsonl.gz' else 'zstd'
+        lines, decode_line = read_s3_lines(s3_client, s3_path, compression, decode=False), serializer.decode_jsonl
+    for line in lines:
+        record = decode_line(line, db_list)
+        if record is not None:
+            yield record
 
 aws_region_list = ['us-east-2','us-east-1','us-west-1','us-west-2','af-south-1','ap-east-1','ap-south-1','ap-northeast-3'
     ,'ap-northeast-2','ap-southeast-1','ap-southeast-2','ap-northeast-1','ca-central-1','eu-central-1','eu-west-1','eu-west-2'
     ,'eu-south-1','eu-west-3','eu-north-1','me-south-1','sa-east-1']
 
-def compare_df(source_df, target_df, df_index):
-    source_df.set_index(df_index)
-    target_df.set_index(df_index)
-    merged_df = source_df.merge(target_df, how='outer', indicator=True)
-    return merged_df[merged_df['_merge'] == 'both'], merged_df[merged_df['_merge'] == 'left_only'], merged_df[merged_df['_merge'] == 'right_only']
-
 def get_database_name(row):
     resource_name = list(row.get('Resource', {}))
     if resource_name == ['Database']:
@@ -46,59 +267,387 @@ def get_database_name(row):
         return row.get('Resource', {}).get('Table', {}).get('DatabaseName', None)
     elif resource_name == ['TableWithColumns']:
         return row.get('Resource', {}).get('TableWithColumns', {}).get('DatabaseName', None)
+    elif resource_name == ['DataCellsFilter']:
+        return row.get('Resource', {}).get('DataCellsFilter', {}).get('DatabaseName', None)
     else:
         return None
 
-def store_permission_data(permission_data,permissions_from_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name):
-    f = tempfile.TemporaryFile(mode='w+')
-    for pd in permission_data:
-        f.write(json.dumps(pd) + "\n")
-    rf = open(f.name,'r+b')
+def get_permission_shard_path(lf_storage_bucket, lf_storage_folder, region, lf_storage_file_name, db_name=None):
+    shard_name = 'catalog' if db_name is None else f"database={db_name}"
+    return f"s3://{lf_storage_bucket}/{lf_storage_folder}/{region}/{shard_name}/{lf_storage_file_name}"
+
+def store_permission_data(permission_data,permissions_from_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name, worker_count=4):
+    """Writes permissions as one shard per database plus a catalog shard for the permissions outside of any database.
+
+    The storage file itself becomes a manifest listing the shards, so readers only fetch the databases they need.
+    """
     output_file_name = f"s3://{lf_storage_bucket}/{lf_storage_folder}/{permissions_from_region}/{lf_storage_file_name}"
     print (f"Writing to output file name {output_file_name}")
-    wr.s3.upload(local_file=rf, path=output_file_name)
-    f.close()
+    s3_client = get_client(permissions_from_region, 's3', max_pool_connections=worker_count)
+    serializer = get_serializer()
+    shard_writers = {}
+    shard_counts = Counter()
+    try:
+        for permission in permission_data:
+            database_name = get_database_name(permission)
+            if database_name not in shard_writers:
+                shard_writers[database_name] = S3StreamWriter(s3_client, get_permission_shard_path(
+                    lf_storage_bucket, lf_storage_folder, permissions_from_region, lf_storage_file_name, database_name))
+            shard_writers[database_name].write(serializer.dumps(permission) + b"\n")
+            shard_counts[database_name] += 1
+    except BaseException:
+        for shard_writer in shard_writers.values():
+            shard_writer.abort()
+        raise
+    # Most shards are smaller than one part and are only sent here, with a PutObject each
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        list(executor.map(S3StreamWriter.close, shard_writers.values()))
+    manifest = {'shards': [{'database': database_name, 'path': shard_writer.s3_path, 'count': shard_counts[database_name]}
+                           for database_name, shard_writer in shard_writers.items()]}
+    bucket, key = split_s3_path(output_file_name)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+    print (f"Stored {sum(shard_counts.values())} permissions in {len(shard_writers)} shards")
+
+def get_permission_shards(s3_client, s3_path, db_list):
+    """Returns the shards of the permission store at s3_path holding the permissions of the databases in db_list."""
+    bucket, key = split_s3_path(s3_path)
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    return [shard for shard in manifest['shards']
+            if shard['database'] is not None and (db_list == ['ALL_DATABASE'] or shard['database'] in db_list)]
+
+def read_shard_permission_keys(s3_client, shard, remapper=None):
+    serializer = get_serializer()
+    permission_keys = set()
+    for r_row in read_s3_lines(s3_client, shard['path'], decode=False):
+        row = serializer.loads(r_row)
+        permission_keys.update(get_permission_keys(remapper.remap(row) if remapper else row))
+    return permission_keys
+
+def read_permission_keys(s3_client, s3_path, db_list, worker_count=4, remapper=None):
+    """Returns the permission keys of the databases in db_list, reading their shards concurrently."""
+    permission_keys = set()
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        for shard_keys in executor.map(partial(read_shard_permission_keys, s3_client, remapper=remapper),
+                                       get_permission_shards(s3_client, s3_path, db_list)):
+            permission_keys.update(shard_keys)
+    return permission_keys
+
+def apply_permission_batch(lf_client, entries, operation='grant', max_attempts=5):
+    """Applies up to PERMISSION_BATCH_SIZE entries with BatchGrantPermissions or BatchRevokePermissions and returns
+    the entries that still failed.
+
+    Entries failing with a transient error are applied again with exponential backoff, other failures are returned as is.
+    """
+    batch_operation = getattr(lf_client, f"batch_{operation}_permissions")
+    pending_entries = {str(entry_id): entry for entry_id, entry in enumerate(entries)}
+    failures = []
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = batch_operation(Entries=[dict(entry, Id=entry_id) for entry_id, entry in pending_entries.items()])
+        except botocore.exceptions.ClientError as e:
+            # The client already retried throttled calls, anything left fails every entry of the batch
+            error = {'ErrorCode': e.response['Error']['Code'], 'ErrorMessage': e.response['Error'].get('Message')}
+            return failures + [{'RequestEntry': entry, 'Error': error} for entry in pending_entries.values()]
+        retry_entries = {}
+        for failure in response.get('Failures', []):
+            entry_id = failure['RequestEntry']['Id']
+            if failure['Error']['ErrorCode'] in PERMISSION_RETRY_ERROR_CODES and attempt < max_attempts:
+                retry_entries[entry_id] = pending_entries[entry_id]
+            else:
+                failures.append(failure)
+        if not retry_entries:
+            break
+        pending_entries = retry_entries
+        time.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+    return failures
+
+def apply_permission_entries(lf_client, entries, operation='grant', worker_count=4, checkpoint=None):
+    """Applies entries in batches of PERMISSION_BATCH_SIZE and returns the failed entries.
+
+    With a checkpoint the number of leading batches that completed is kept as the batch cursor of the operation, and
+    a rerun starts after it."""
+    batches = get_chunks(entries, PERMISSION_BATCH_SIZE)
+    cursor_name = f"{operation}_batch_cursor"
+    batch_cursor = checkpoint.get('permissions').get(cursor_name, 0) if checkpoint else 0
+    if batch_cursor:
+        print(f"Resuming {operation} after {batch_cursor} of {len(batches)} batches")
+    failures = []
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        # map returns the batches in order, so the cursor only ever covers batches that all completed
+        for batch_index, batch_failures in enumerate(executor.map(partial(apply_permission_batch, lf_client, operation=operation),
+                                                                  batches[batch_cursor:]), batch_cursor):
+            failures.extend(batch_failures)
+            if checkpoint:
+                checkpoint.update('permissions', **{cursor_name: batch_index + 1})
+                checkpoint.save(force=False)
+    return failures
 
-def apply_table_permissions(file_location, destination_client, db_list,source_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name):
+def store_permission_failures(failures, lf_client, operation, lf_storage_bucket, lf_storage_folder, lf_storage_file_name):
+    print(f"Failed to {operation} {len(failures)} permission entries")
+    for error_code, error_count in Counter(failure['Error']['ErrorCode'] for failure in failures).most_common():
+        print(f"    {error_code}: {error_count}")
+    output_file_name = f"s3://{lf_storage_bucket}/{lf_storage_folder}/{lf_client.meta.region_name}/{operation}_failures_{lf_storage_file_name}"
+    print(f"Writing {operation} failures to {output_file_name}")
+    with S3StreamWriter(get_client(lf_client.meta.region_name, 's3'), output_file_name) as failure_file:
+        for failure in failures:
+            failure_file.write((json.dumps(failure, default=str) + "\n").encode('utf-8'))
+
+def apply_table_permissions(file_location, destination_client, db_list,source_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name, worker_count=4, revoke_extra_permissions=False, remapper=None, checkpoint=None):
     print ("Reading permissions from s3 location")
-    f = tempfile.TemporaryFile(mode='w+b')
-    s3_client = get_client(source_region, 's3')
-    s3_client.download_fileobj(f"{lf_storage_bucket}", f"{lf_storage_folder}/{source_region}/{lf_storage_file_name}", f)
+    target_region = destination_client.meta.region_name
     print (f"{lf_storage_bucket}/{lf_storage_folder}/{source_region}/{lf_storage_file_name}")
-    f.seek(0)
-    rf = open(f.name,'r+')
-    for r_row in rf.readlines():
-        row  = json.loads(r_row)
-        database_name = get_database_name(row)
-        if database_name in db_list:
-            print (f"Applying {row}")
-            if 'Table' in row['Resource'] and 'Name' in row['Resource']['Table'] and row['Resource']['Table']['Name'] == 'ALL_TABLES':
-                del row['Resource']['Table']['Name']
-                row['Resource']['Table']['TableWildcard'] = {}
-            if 'TableWithColumns' in row['Resource'] and 'Name' in row['Resource']['TableWithColumns'] and row['Resource']['TableWithColumns']['Name'] == 'ALL_TABLES':
-                row['Resource']['Table'] = row['Resource']['TableWithColumns']
-                del row['Resource']['Table']['Name']
-                del row['Resource']['Table']['ColumnWildcard']
-                del row['Resource']['TableWithColumns']
-                row['Resource']['Table']['TableWildcard'] = {}
-            response = destination_client.grant_permissions(**row)
-    f.close()
-    print ("Done applying table permissions")
-
-def get_permissions(source_client):
-    print("Processing permissions")
-    result = source_client.list_permissions()
-    principal_permissions = result['PrincipalResourcePermissions']
-    fetch = True
-    while fetch:
-        try:
-            token = result['NextToken']
-            result = source_client.list_permissions(NextToken=token)
+    source_keys = read_permission_keys(get_client(source_region, 's3', max_pool_connections=worker_count),
+                                       f"s3://{lf_storage_bucket}/{lf_storage_folder}/{source_region}/{lf_storage_file_name}", db_list, worker_count, remapper)
+    print (f"{lf_storage_bucket}/{lf_storage_folder}/{target_region}/{lf_storage_file_name}")
+    target_keys = read_permission_keys(get_client(target_region, 's3', max_pool_connections=worker_count),
+                                       f"s3://{lf_storage_bucket}/{lf_storage_folder}/{target_region}/{lf_storage_file_name}", db_list, worker_count)
+    grant_entries, revoke_entries = get_permission_changes(source_keys, target_keys, revoke_extra_permissions)
+    print (f"Source has {len(source_keys)} permissions and target has {len(target_keys)}, "
+           f"granting {len(grant_entries)} and revoking {len(revoke_entries)} permission entries")
+    failures = {}
+    # Revoke first, a permission whose grant option differs is revoked and granted again with the source grant option
+    for operation, entries in [('revoke', revoke_entries), ('grant', grant_entries)]:
+        failures[operation] = apply_permission_entries(destination_client, entries, operation, worker_count, checkpoint)
+        if failures[operation]:
+            store_permission_failures(failures[operation], destination_client, operation, lf_storage_bucket, lf_storage_folder, lf_storage_file_name)
+    print (f"Done applying table permissions, {len(grant_entries) - len(failures['grant'])} granted and "
+           f"{len(revoke_entries) - len(failures['revoke'])} revoked")
+    return failures
+
+def list_permissions(lf_client, scope):
+    """Returns the PrincipalResourcePermissions of one list_permissions scope, none when its resource does not exist."""
+    permission_request = dict(scope)
+    principal_permissions = []
+    try:
+        while True:
+            result = lf_client.list_permissions(**permission_request)
             principal_permissions.extend(result['PrincipalResourcePermissions'])
-        except KeyError:
-            fetch = False
-    return principal_permissions
+            if 'NextToken' not in result:
+                return principal_permissions
+            permission_request['NextToken'] = result['NextToken']
+    except lf_client.exceptions.EntityNotFoundException:
+        return []
+
+def list_table_names(glue_client, db_name):
+    try:
+        return [table['Name'] for table in list_tables(glue_client, db_name)]
+    except glue_client.exceptions.EntityNotFoundException:
+        return []
+
+def get_catalog_table_names(glue_client, db_list, worker_count=4):
+    """Returns {database: table names} of the databases in db_list, listing the databases concurrently."""
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        return dict(zip(db_list, executor.map(partial(list_table_names, glue_client), db_list)))
+
+def list_data_cells_filters(lf_client, table=None):
+    """Returns the data cells filters of a table, or of the whole catalog when no table is given."""
+    filter_request = {'Table': table} if table else {}
+    data_cells_filters = []
+    try:
+        while True:
+            result = lf_client.list_data_cells_filter(**filter_request)
+            data_cells_filters.extend(result['DataCellsFilters'])
+            if 'NextToken' not in result:
+                return data_cells_filters
+            filter_request['NextToken'] = result['NextToken']
+    except lf_client.exceptions.EntityNotFoundException:
+        return []
+
+def get_data_cells_filters(lf_client, catalog_table_names, worker_count=4):
+    """Returns {(database, table, filter name): filter} of the tables in catalog_table_names, listing the tables
+    concurrently. All the filters of the catalog are returned when catalog_table_names is None."""
+    if catalog_table_names is None:
+        data_cells_filters = list_data_cells_filters(lf_client)
+    else:
+        tables = [{'DatabaseName': db_name, 'Name': table_name}
+                  for db_name, table_names in catalog_table_names.items() for table_name in table_names]
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            data_cells_filters = [data_cells_filter for table_filters in executor.map(partial(list_data_cells_filters, lf_client), tables)
+                                  for data_cells_filter in table_filters]
+    return {(data_cells_filter['DatabaseName'], data_cells_filter['TableName'], data_cells_filter['Name']): data_cells_filter
+            for data_cells_filter in data_cells_filters}
+
+def get_permission_scopes(catalog_table_names, data_cells_filters):
+    """Returns the list_permissions scopes covering the databases of catalog_table_names, their tables, their ALL_TABLES
+    grants and their data cells filters. Resource types are used instead when catalog_table_names is None."""
+    if catalog_table_names is None:
+        scopes = [{'ResourceType': 'DATABASE'}, {'ResourceType': 'TABLE'}]
+    else:
+        scopes = []
+        for db_name, table_names in catalog_table_names.items():
+            scopes.append({'Resource': {'Database': {'Name': db_name}}})
+            scopes.append({'Resource': {'Table': {'DatabaseName': db_name, 'TableWildcard': {}}}})
+            scopes.extend({'Resource': {'Table': {'DatabaseName': db_name, 'Name': table_name}}} for table_name in table_names)
+    scopes.extend({'Resource': {'DataCellsFilter': {'TableCatalogId': data_cells_filter['TableCatalogId'], 'DatabaseName': db_name,
+                                                    'TableName': table_name, 'Name': filter_name}}}
+                  for (db_name, table_name, filter_name), data_cells_filter in data_cells_filters.items())
+    return scopes
+
+def get_permissions(source_client, db_list, worker_count=4):
+    """Yields the permissions on the databases of db_list and their tables, listing the scopes concurrently.
+
+    Rows are yielded as soon as their scope is listed and the same row returned by two scopes is only yielded once.
+    """
+    print("Processing permissions")
+    region_name = source_client.meta.region_name
+    catalog_table_names = None if db_list == ['ALL_DATABASE'] else get_catalog_table_names(
+        get_client(region_name, 'glue', max_pool_connections=worker_count), db_list, worker_count)
+    scopes = iter(get_permission_scopes(catalog_table_names, get_data_cells_filters(source_client, catalog_table_names, worker_count)))
+    seen_permissions = set()
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        permission_futures = {executor.submit(list_permissions, source_client, scope)
+                              for scope in itertools.islice(scopes, worker_count * 2)}
+        while permission_futures:
+            done, permission_futures = wait(permission_futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                for row in future.result():
+                    fingerprint = get_fingerprint(row)
+                    if fingerprint not in seen_permissions:
+                        seen_permissions.add(fingerprint)
+                        yield row
+                for scope in itertools.islice(scopes, 1):
+                    permission_futures.add(executor.submit(list_permissions, source_client, scope))
+    print(f"Listed {len(seen_permissions)} permissions in {region_name}")
+
 
+def list_lf_tags(lf_client):
+    """Returns {tag key: tag values} of the LF-Tags defined in the catalog of lf_client."""
+    lf_tags = {}
+    tag_request = {}
+    while True:
+        result = lf_client.list_lf_tags(**tag_request)
+        lf_tags.update({lf_tag['TagKey']: lf_tag['TagValues'] for lf_tag in result['LFTags']})
+        if 'NextToken' not in result:
+            return lf_tags
+        tag_request['NextToken'] = result['NextToken']
+
+def search_lf_tag_resources(lf_client, operation_name, result_key, tag_key, tag_values):
+    search_operation = getattr(lf_client, operation_name)
+    search_request = {'Expression': [{'TagKey': tag_key, 'TagValues': tag_values}]}
+    resources = []
+    while True:
+        result = search_operation(**search_request)
+        resources.extend(result[result_key])
+        if 'NextToken' not in result:
+            return resources
+        search_request['NextToken'] = result['NextToken']
+
+def get_lf_tag_assignments(lf_client, lf_tags, db_list, worker_count=4):
+    """Returns {resource: {tag key: tag values}} of the LF-Tags assigned to the databases in db_list, their tables and
+    their columns.
+
+    Resources are canonical JSON strings. A tag a table inherits from its database, or a column from its table, is
+    left out so that only the assignments made on the resource itself are replicated.
+    """
+    assignments = {}
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        database_futures = [executor.submit(search_lf_tag_resources, lf_client, 'search_databases_by_lf_tags', 'DatabaseList', tag_key, tag_values)
+                            for tag_key, tag_values in lf_tags.items()]
+        table_futures = [executor.submit(search_lf_tag_resources, lf_client, 'search_tables_by_lf_tags', 'TableList', tag_key, tag_values)
+                         for tag_key, tag_values in lf_tags.items()]
+        for future in database_futures:
+            for tagged_database in future.result():
+                db_name = tagged_database['Database']['Name']
+                if db_list == ['ALL_DATABASE'] or db_name in db_list:
+                    resource = json.dumps({'Database': {'Name': db_name}}, sort_keys=True)
+                    assignments[resource] = {lf_tag['TagKey']: sorted(lf_tag['TagValues']) for lf_tag in tagged_database.get('LFTags', [])}
+        for future in table_futures:
+            for tagged_table in future.result():
+                db_name, table_name = tagged_table['Table']['DatabaseName'], tagged_table['Table']['Name']
+                if not (db_list == ['ALL_DATABASE'] or db_name in db_list):
+                    continue
+                database_tags = {lf_tag['TagKey']: sorted(lf_tag['TagValues']) for lf_tag in tagged_table.get('LFTagOnDatabase', [])}
+                table_tags = {lf_tag['TagKey']: sorted(lf_tag['TagValues']) for lf_tag in tagged_table.get('LFTagsOnTable', [])}
+                resource = json.dumps({'Table': {'DatabaseName': db_name, 'Name': table_name}}, sort_keys=True)
+                assignments[resource] = {tag_key: tag_values for tag_key, tag_values in table_tags.items()
+                                         if database_tags.get(tag_key) != tag_values}
+                for column in tagged_table.get('LFTagsOnColumns', []):
+                    resource = json.dumps({'TableWithColumns': {'DatabaseName': db_name, 'Name': table_name, 'ColumnNames': [column['Name']]}}, sort_keys=True)
+                    assignments[resource] = {lf_tag['TagKey']: sorted(lf_tag['TagValues']) for lf_tag in column.get('LFTags', [])
+                                             if table_tags.get(lf_tag['TagKey']) != sorted(lf_tag['TagValues'])}
+    return {resource: resource_tags for resource, resource_tags in assignments.items() if resource_tags}
+
+def add_lf_tags_to_resource(lf_client, resource, resource_tags):
+    response = lf_client.add_lf_tags_to_resource(Resource=json.loads(resource),
+                                                 LFTags=[{'TagKey': tag_key, 'TagValues': tag_values} for tag_key, tag_values in resource_tags.items()])
+    for failure in response.get('Failures', []):
+        print(f"Failed to assign LF-Tag {failure['LFTag']['TagKey']} to {resource}. Reason: {failure['Error']}")
+    return len(response.get('Failures', []))
+
+def list_lf_tag_permission_keys(lf_client, remapper=None):
+    permission_keys = set()
+    for resource_type in LF_TAG_PERMISSION_RESOURCE_TYPES:
+        for row in list_permissions(lf_client, {'ResourceType': resource_type}):
+            permission_keys.update(get_permission_keys(remapper.remap(row) if remapper else row))
+    return permission_keys
+
+def sync_lf_tags(source_client, destination_client, db_list, lf_storage_bucket, lf_storage_folder, lf_storage_file_name, worker_count=4, remapper=None):
+    """Replicates LF-Tag definitions, their assignments on the databases in db_list and the LF-Tag based grants."""
+    print ("Synchronizing LF-Tags")
+    source_tags = list_lf_tags(source_client)
+    target_tags = list_lf_tags(destination_client)
+    for tag_key, tag_values in source_tags.items():
+        if tag_key not in target_tags:
+            print (f"Creating LF-Tag {tag_key}")
+            destination_client.create_lf_tag(TagKey=tag_key, TagValues=tag_values)
+            continue
+        for tag_values_chunk in get_chunks(sorted(set(tag_values) - set(target_tags[tag_key])), LF_TAG_VALUE_BATCH_SIZE):
+            print (f"Adding values {tag_values_chunk} to LF-Tag {tag_key}")
+            destination_client.update_lf_tag(TagKey=tag_key, TagValuesToAdd=tag_values_chunk)
+
+    source_assignments = get_lf_tag_assignments(source_client, source_tags, db_list, worker_count)
+    target_assignments = get_lf_tag_assignments(destination_client, target_tags, db_list, worker_count)
+    missing_assignments = {}
+    for resource, resource_tags in source_assignments.items():
+        target_resource_tags = target_assignments.get(resource, {})
+        missing_tags = {tag_key: tag_values for tag_key, tag_values in resource_tags.items() if target_resource_tags.get(tag_key) != tag_values}
+        if missing_tags:
+            missing_assignments[resource] = missing_tags
+    print (f"Assigning LF-Tags to {len(missing_assignments)} of {len(source_assignments)} tagged resources")
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        failed_count = sum(executor.map(partial(add_lf_tags_to_resource, destination_client), missing_assignments, missing_assignments.values()))
+
+    # LF-Tag based grants can only be replayed once the tags exist in the target
+    grant_entries = get_permission_entries(list_lf_tag_permission_keys(source_client, remapper) - list_lf_tag_permission_keys(destination_client))
+    print (f"Granting {len(grant_entries)} LF-Tag permission entries")
+    failures = apply_permission_entries(destination_client, grant_entries, 'grant', worker_count)
+    if failures:
+        store_permission_failures(failures, destination_client, 'grant', lf_storage_bucket, lf_storage_folder, f"lf_tag_{lf_storage_file_name}")
+    print (f"Done synchronizing LF-Tags, {failed_count} assignments and {len(failures)} permission entries failed")
+
+def apply_data_cells_filter(lf_client, data_cells_filter, exists=False):
+    try:
+        if exists:
+            lf_client.update_data_cells_filter(TableData=data_cells_filter)
+        else:
+            lf_client.create_data_cells_filter(TableData=data_cells_filter)
+        return 0
+    except botocore.exceptions.ClientError as e:
+        print(f"Failed to {'update' if exists else 'create'} data cells filter {data_cells_filter['DatabaseName']}."
+              f"{data_cells_filter['TableName']}.{data_cells_filter['Name']}. Reason: {e.response['Error']}")
+        return 1
+
+def sync_data_cells_filters(source_client, destination_client, db_list, worker_count=4):
+    """Creates the data cells filters of the tables in db_list that are missing in the target and updates the ones that
+    differ. The filters have to exist before the DataCellsFilter grants are applied."""
+    print ("Synchronizing data cells filters")
+    source_filters, target_filters = [
+        get_data_cells_filters(lf_client, None if db_list == ['ALL_DATABASE'] else get_catalog_table_names(
+            get_client(lf_client.meta.region_name, 'glue', max_pool_connections=worker_count), db_list, worker_count), worker_count)
+        for lf_client in (source_client, destination_client)]
+    target_catalog_id = get_client(destination_client.meta.region_name, 'sts').get_caller_identity()['Account']
+    filters_to_apply = []
+    for filter_key, data_cells_filter in source_filters.items():
+        data_cells_filter = dict(normalize_catalog_object(data_cells_filter, data_cells_filter_keys_to_be_removed), TableCatalogId=target_catalog_id)
+        if filter_key not in target_filters:
+            filters_to_apply.append((data_cells_filter, False))
+        elif normalize_catalog_object(target_filters[filter_key], data_cells_filter_keys_to_be_removed) != \
+                normalize_catalog_object(data_cells_filter, data_cells_filter_keys_to_be_removed):
+            filters_to_apply.append((data_cells_filter, True))
+    print (f"Applying {len(filters_to_apply)} of {len(source_filters)} data cells filters")
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        failed_count = sum(executor.map(partial(apply_data_cells_filter, destination_client), *zip(*filters_to_apply))) if filters_to_apply else 0
+    print (f"Done synchronizing data cells filters, {failed_count} failed")
 
 def create_table(glue_client, db_name, table):
     try:
@@ -113,13 +662,7 @@ def create_database(glue_client,database_input):
         res = glue_client.update_database(DatabaseInput=database_input, Name=database_input['Name'])
 
 def update_location(s3_location, table_s3_mapping):
-    if s3_location:
-        u = urlparse(s3_location)
-        if u.netloc in table_s3_mapping:
-            target_s3_location = table_s3_mapping[u.netloc]
-            u = u._replace(netloc=target_s3_location)
-            return urlunparse(u)
-    return s3_location
+    return table_s3_mapping.map(s3_location)
 
 def update_database_location(database_data, table_s3_mapping):
     if 'LocationUri' in database_data:
@@ -132,166 +675,748 @@ def update_table_location(table_data, table_s3_mapping):
         table_data['StorageDescriptor']['Location'] = update_location(storage_descriptor.get('Location'), table_s3_mapping)
     return table_data
 
-def create_or_update_partition(glue_client, db_name, table_name, partition_data, update_table_s3_location, table_s3_mapping):
-    try:
-        if update_table_s3_location:
-            partition_data = update_table_location(partition_data, table_s3_mapping)
-        partition_input = {
-            'Values': partition_data.get('Values', []),
-            'StorageDescriptor': partition_data.get('StorageDescriptor', {}),
-            'Parameters': partition_data.get('Parameters', {})
-        }
-        glue_client.create_partition(
+def get_partition_input(partition_data, update_table_s3_location, table_s3_mapping):
+    if update_table_s3_location:
+        partition_data = update_table_location(partition_data, table_s3_mapping)
+    return {
+        'Values': partition_data.get('Values', []),
+        'StorageDescriptor': partition_data.get('StorageDescriptor', {}),
+        'Parameters': partition_data.get('Parameters', {})
+    }
+
+def get_fingerprint(data):
+    return hashlib.blake2b(json.dumps(data, sort_keys=True, default=str).encode('utf-8'), digest_size=16).digest()
+
+def normalize_catalog_object(data, keys_to_be_removed):
+    return {key: value for key, value in data.items() if key not in keys_to_be_removed}
+
+class TargetCatalogIndex:
+    """Fingerprints of the databases, tables and partitions already in the target catalog.
+
+    Databases and tables are read up front, the partitions of a table are read the first time a batch of them is
+    restored. Fingerprints are taken on the same normalized shape the extract writes, so an unchanged object has the
+    same fingerprint on both sides."""
+
+    def __init__(self, glue_client, db_list=None, worker_count=8):
+        self.glue_client = glue_client
+        self._lock = threading.Lock()
+        self._partition_locks = {}
+        self._partitions = {}
+        self.databases = {}
+        self.tables = {}
+        for page in glue_client.get_paginator('get_databases').paginate():
+            for db in page['DatabaseList']:
+                if db_list is None or db['Name'] in db_list:
+                    self.databases[db['Name']] = get_fingerprint(normalize_catalog_object(db, database_keys_to_be_removed))
+        db_names = list(self.databases)
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            for db_name, tables in zip(db_names, executor.map(partial(list_tables, glue_client), db_names)):
+                for table in tables:
+                    self.tables[(db_name, table['Name'])] = get_fingerprint(normalize_catalog_object(table, table_keys_to_be_removed))
+        print(f"Indexed {len(self.databases)} databases and {len(self.tables)} tables of the target catalog")
+
+    def is_database_unchanged(self, database_data):
+        return self.databases.get(database_data['Name']) == get_fingerprint(database_data)
+
+    def is_table_unchanged(self, db_name, table_data):
+        return self.tables.get((db_name, table_data['Name'])) == get_fingerprint(table_data)
+
+    def partition_fingerprints(self, db_name, table_name):
+        key = (db_name, table_name)
+        if key not in self.tables:
+            return {}
+        with self._lock:
+            table_lock = self._partition_locks.setdefault(key, threading.Lock())
+        with table_lock:
+            if key not in self._partitions:
+                partition_paginator = self.glue_client.get_paginator("get_partitions")
+                self._partitions[key] = {tuple(partition['Values']): get_fingerprint(get_partition_input(partition, False, None))
+                                         for page in partition_paginator.paginate(DatabaseName=db_name, TableName=table_name)
+                                         for partition in page['Partitions']}
+        return self._partitions[key]
+
+def create_or_update_partitions(glue_client, db_name, table_name, partition_inputs, table_future=None, target_index=None):
+    # Partitions can only be created once the parent table has been restored
+    if table_future is not None:
+        table_future.result()
+    create_inputs = partition_inputs
+    update_inputs = []
+    if target_index is not None:
+        # Partitions missing in the target are created, different ones are updated and identical ones skipped
+        target_partitions = target_index.partition_fingerprints(db_name, table_name)
+        create_inputs = []
+        for partition_input in partition_inputs:
+            target_fingerprint = target_partitions.get(tuple(partition_input['Values']))
+            if target_fingerprint is None:
+                create_inputs.append(partition_input)
+            elif target_fingerprint != get_fingerprint(partition_input):
+                update_inputs.append(partition_input)
+    failed_partitions = []
+    created_count = len(create_inputs)
+    if create_inputs:
+        response = glue_client.batch_create_partition(
             DatabaseName=db_name,
             TableName=table_name,
-            PartitionInput=partition_input
+            PartitionInputList=create_inputs
         )
-        print(f"Successfully created partition: {partition_data['Values']}")
-    except glue_client.exceptions.AlreadyExistsException:
-        try:
-            glue_client.update_partition(
-                DatabaseName=db_name,
-                TableName=table_name,
-                PartitionValueList=partition_data['Values'],
-                PartitionInput=partition_input
-            )
-            print(f"Successfully updated partition: {partition_data['Values']}")
-        except Exception as update_err:
-            print(f"Failed to update partition {partition_data['Values']}. Reason: {update_err}")
-            raise update_err
-    except Exception as e:
-        print(f"Failed to create partition {partition_data['Values']}. Reason: {e}")
-        raise e
-
-def restore_data(config, data_source, glue_client, update_table_s3_location, table_s3_mapping):
+        partition_inputs_by_values = {tuple(p['Values']): p for p in create_inputs}
+        for error in response.get('Errors', []):
+            if error['ErrorDetail']['ErrorCode'] == 'AlreadyExistsException':
+                update_inputs.append(partition_inputs_by_values[tuple(error['PartitionValues'])])
+            else:
+                failed_partitions.append((error['PartitionValues'], error['ErrorDetail']))
+            created_count -= 1
+    if update_inputs:
+        response = glue_client.batch_update_partition(
+            DatabaseName=db_name,
+            TableName=table_name,
+            Entries=[{'PartitionValueList': p['Values'], 'PartitionInput': p} for p in update_inputs]
+        )
+        for error in response.get('Errors', []):
+            failed_partitions.append((error['PartitionValueList'], error['ErrorDetail']))
+    for values, error_detail in failed_partitions:
+        print(f"Failed to create or update partition {values} of {db_name}.{table_name}. Reason: {error_detail}")
+    if failed_partitions:
+        raise RuntimeError(f"{len(failed_partitions)} partitions of {db_name}.{table_name} could not be restored")
+    skipped_count = len(partition_inputs) - created_count - len(update_inputs)
+    print(f"Restored {len(partition_inputs)} partitions of {db_name}.{table_name} "
+          f"(created {created_count}, updated {len(update_inputs)}, unchanged {skipped_count})")
+    return skipped_count
+
+def restore_data(config, data_source, glue_client, update_table_s3_location, table_s3_mapping, s3_paths=None, checkpoint=None):
+    restore_state = checkpoint.get('restore') if checkpoint else {}
+    if restore_state.get('done'):
+        print("Restore already completed according to the checkpoint, skipping")
+        return
     print("Restoring database...")
     database_count = Counter()
     table_count = Counter()
     partition_count = Counter()
-    s3_path = config[data_source]['s3_data_path']
-    f = tempfile.TemporaryFile(mode='w+b')
-    wr.s3.download(path=s3_path, local_file=f)
-    f.seek(0)
-    rf = open(f.name, "r+t")
-    for object_data_line in rf.readlines():
-        object_type, db_name, object_name, object_data = object_data_line.split("\t")
-        print(f"Processing object_type {object_type} {db_name} {object_name} ")
-        if object_type == 'database':
-            database_data = json.loads(object_data)
-            if update_table_s3_location:
-                database_data = update_database_location(database_data, table_s3_mapping)
-            create_database(glue_client, database_data)
-            database_count[db_name] += 1
-        elif object_type == 'table':
-            table_data = json.loads(object_data)
-            if update_table_s3_location:
-                table_data = update_table_location(table_data, table_s3_mapping)
-            create_table(glue_client, db_name, table_data)
-            table_count[db_name] += 1
-        elif object_type == 'partition':
-            partition_data = json.loads(object_data)
-            create_or_update_partition(glue_client, db_name, object_name, partition_data, update_table_s3_location, table_s3_mapping)
-            partition_count[db_name] += 1
-    rf.close()
+    worker_count = config.getint('Performance', 'restore_worker_count', fallback=8)
+    s3_paths = s3_paths or [config[data_source]['s3_data_path']]
+    backup_format = config.get(data_source, 'backup_format', fallback='tsv')
+    serializer = get_serializer(config.get('Performance', 'serializer', fallback='auto'))
+    db_list = ast.literal_eval(config[data_source]['database_list'])
+    restore_db_list = None if db_list == ['ALL_DATABASE'] else db_list
+    s3_client = get_client(config['AwsDataCatalog']['source_region'], 's3')
+    remapper = get_catalog_remapper(config)
+    target_index = None
+    if config.getboolean('Performance', 'restore_skip_unchanged', fallback=True):
+        target_index = TargetCatalogIndex(glue_client, restore_db_list, worker_count)
+    skipped_count = Counter()
+    # Databases are created inline before any of their tables are read. Tables run on the pool and every
+    # partition batch waits on the future of its table, so the create order database -> table -> partition
+    # is kept while independent tables and partition batches are restored concurrently.
+    table_futures = {}
+    table_storage_descriptors = {}
+    partition_futures = []
+    pending_partitions = {}
+    in_flight = threading.BoundedSemaphore(worker_count * 4)
+    # The checkpoint position is the (path index, record index) of the first record whose work is not known to be
+    # done: the oldest unfinished or failed future, the oldest buffered partition or the next record to read.
+    # A rerun skips the records before it, except for the table descriptors that delta partitions are rebuilt from.
+    resume_position = tuple(restore_state.get('position', (0, 0)))
+    if resume_position > (0, 0):
+        print(f"Resuming the restore at record {resume_position[1]} of {s3_paths[resume_position[0]]}")
+    pending_positions = {}
+    pending_partition_positions = {}
+    positions_lock = threading.Lock()
+
+    def release_position(future):
+        # A failed future keeps its position so that the rerun starts at or before it
+        if future.exception() is None:
+            with positions_lock:
+                pending_positions.pop(future, None)
+
+    def save_position(position, force=False):
+        with positions_lock:
+            position = min([position, *pending_positions.values(), *pending_partition_positions.values()])
+        checkpoint.update('restore', position=list(position))
+        checkpoint.save(force)
+
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        def submit(position, fn, *args):
+            in_flight.acquire()
+            future = executor.submit(fn, *args)
+            with positions_lock:
+                pending_positions[future] = position
+            future.add_done_callback(lambda _: in_flight.release())
+            future.add_done_callback(release_position)
+            return future
+
+        def submit_partitions(db_name, table_name):
+            partition_inputs = pending_partitions.pop((db_name, table_name))
+            future = submit(pending_partition_positions[(db_name, table_name)], create_or_update_partitions, glue_client, db_name, table_name,
+                            partition_inputs, table_futures.get((db_name, table_name)), target_index)
+            with positions_lock:
+                del pending_partition_positions[(db_name, table_name)]
+            partition_futures.append(future)
+
+        catalog_records = (((path_index, record_index), record)
+                           for path_index, s3_path in enumerate(s3_paths)
+                           for record_index, record in enumerate(read_catalog_records(s3_client, s3_path, backup_format, restore_db_list, serializer)))
+        position = resume_position
+        try:
+            for position, (object_type, db_name, object_name, object_data) in catalog_records:
+                if position < resume_position:
+                    if object_type == 'table':
+                        table_storage_descriptors[(db_name, object_name)] = dict(object_data.get('StorageDescriptor', {}))
+                    continue
+                if checkpoint and position[1] % CHECKPOINT_RECORD_INTERVAL == 0:
+                    save_position(position)
+                if object_type == 'database':
+                    print(f"Processing object_type {object_type} {db_name} {object_name} ")
+                    database_data = remapper.remap(object_data)
+                    if update_table_s3_location:
+                        database_data = update_database_location(database_data, table_s3_mapping)
+                    if target_index is not None and target_index.is_database_unchanged(database_data):
+                        skipped_count['database'] += 1
+                    else:
+                        create_database(glue_client, database_data)
+                    database_count[db_name] += 1
+                elif object_type == 'table':
+                    print(f"Processing object_type {object_type} {db_name} {object_name} ")
+                    table_data = object_data
+                    # Kept before the location mapping, delta encoded partitions are rebuilt from the source descriptor
+                    table_storage_descriptors[(db_name, object_name)] = dict(table_data.get('StorageDescriptor', {}))
+                    table_data = remapper.remap(table_data)
+                    if update_table_s3_location:
+                        table_data = update_table_location(table_data, table_s3_mapping)
+                    if target_index is not None and target_index.is_table_unchanged(db_name, table_data):
+                        skipped_count['table'] += 1
+                    else:
+                        table_futures[(db_name, object_name)] = submit(position, create_table, glue_client, db_name, table_data)
+                    table_count[db_name] += 1
+                elif object_type == 'partition':
+                    partition_data = remapper.remap(decode_partition_delta(object_data, table_storage_descriptors.get((db_name, object_name), {})))
+                    partition_inputs = pending_partitions.setdefault((db_name, object_name), [])
+                    if not partition_inputs:
+                        with positions_lock:
+                            pending_partition_positions[(db_name, object_name)] = position
+                    partition_inputs.append(get_partition_input(partition_data, update_table_s3_location, table_s3_mapping))
+                    if len(partition_inputs) == PARTITION_BATCH_SIZE:
+                        submit_partitions(db_name, object_name)
+                    partition_count[db_name] += 1
+            position = (len(s3_paths), 0)
+            for db_name, table_name in list(pending_partitions):
+                submit_partitions(db_name, table_name)
+            # Surface the first failure the same way the serial restore did
+            for future in table_futures.values():
+                future.result()
+            for future in partition_futures:
+                skipped_count['partition'] += future.result()
+        except BaseException:
+            if checkpoint:
+                # Let the submitted work finish so that the stored position covers everything that succeeded
+                executor.shutdown(wait=True)
+                save_position(position, force=True)
+            raise
+    if checkpoint:
+        checkpoint.update('restore', done=True, position=[len(s3_paths), 0])
+        checkpoint.save()
     for db_name in database_count.keys():
         print(f"{db_name}=>table_count:{table_count[db_name]} partition_count:{partition_count[db_name]}")
-    print(f"Restored database count => {len(list(database_count.keys()))}  table count => {len(list(table_count.elements()))}  partition count => {len(list(partition_count.elements()))}")
-
-def get_tables(source_region, data_source, db_list):
-    session_region = boto3.Session(region_name=source_region)
-    db_list_string = "','".join(db_list)
-    athena_query = f"""SELECT table_schema, table_name FROM  information_schema.tables
-                       where table_schema in ('{db_list_string}') and table_catalog = lower('{data_source}')"""
-    print (f"Running query {athena_query}")
-    df = wr.athena.read_sql_query(athena_query ,database=information_schema_name, ctas_approach=False, boto3_session=session_region)
-    return df
-
-def extract_database(source_region, output_file_name, db_list):
+    print(f"Restored database count => {len(list(database_count.keys()))}  table count => {sum(table_count.values())}  partition count => {sum(partition_count.values())}")
+    if target_index is not None:
+        print(f"Unchanged objects skipped => databases {skipped_count['database']}  tables {skipped_count['table']}  partitions {skipped_count['partition']}")
+
+def list_tables(glue_client, db_name):
+    table_paginator = glue_client.get_paginator("get_tables")
+    return [table for page in table_paginator.paginate(DatabaseName=db_name) for table in page['TableList']]
+
+def write_partitions(partitions, db_name, table_name, catalog_file, table_storage_descriptor=None, created_after=None):
+    if created_after is not None:
+        partitions = [partition for partition in partitions
+                      if partition.get('CreationTime') is None or partition['CreationTime'] > created_after]
+    records = []
+    for partition in partitions:
+        _partition = [partition.pop(key,'') for key in partition_keys_to_be_removed]
+        if table_storage_descriptor is not None:
+            partition = encode_partition_delta(partition, table_storage_descriptor)
+        records.append(('partition', db_name, table_name, partition))
+    catalog_file.write(records)
+    return len(partitions)
+
+def extract_partitions(glue_client, db_name, table_name, catalog_file, table_storage_descriptor=None,
+                       segment_count=1, segment_threshold=1000, segment=None, created_after=None):
+    paginate_args = {'DatabaseName': db_name, 'TableName': table_name}
+    if segment is not None:
+        paginate_args['Segment'] = {'SegmentNumber': segment, 'TotalSegments': segment_count}
+    elif segment_count > 1:
+        # Probe the first page: a table that does not fit in it is handed back to be rescanned in segments
+        probe_page = glue_client.get_partitions(MaxResults=segment_threshold, **paginate_args)
+        if 'NextToken' in probe_page:
+            return None
+        partition_count = write_partitions(probe_page['Partitions'], db_name, table_name, catalog_file, table_storage_descriptor, created_after)
+        print(f"Extracted {partition_count} partitions for table {db_name}.{table_name}")
+        return partition_count
+    partition_paginator = glue_client.get_paginator("get_partitions")
+    partition_count = 0
+    for partition_page in partition_paginator.paginate(**paginate_args):
+        partition_count += write_partitions(partition_page['Partitions'], db_name, table_name, catalog_file, table_storage_descriptor, created_after)
+    segment_name = f" segment {segment + 1}/{segment_count}" if segment is not None else ""
+    print(f"Extracted {partition_count} partitions for table {db_name}.{table_name}{segment_name}")
+    return partition_count
+
+def extract_database(source_region, output_file_name, db_list, worker_count=8, segment_count=1, segment_threshold=1000,
+                     backup_format='tsv', partition_encoding='full', previous_watermarks=None, created_after=None,
+                     scan_unchanged_partitions=False, serializer=None):
+    """Extracts the catalog to output_file_name and returns the UpdateTime/VersionId watermark of every table.
+
+    When previous_watermarks is given only the tables whose watermark changed are written, together with the
+    partitions of unchanged tables created after created_after when scan_unchanged_partitions is set. Deleted tables
+    and partitions are never part of the output."""
     print ("Extracting database...")
     table_count = Counter()
     database_count = Counter()
     partition_count = Counter()
-    glue_client = get_client(source_region,'glue')
-    table_paginator = glue_client.get_paginator("get_tables")
-    partition_paginator = glue_client.get_paginator("get_partitions")
+    glue_client = get_client(source_region,'glue', max_pool_connections=worker_count)
     db_paginator = glue_client.get_paginator("get_databases")
-    database_data_file = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
+    databases = []
     for page in db_paginator.paginate():
         for db in page['DatabaseList']:
             if (db_list == ['ALL_DATABASE'] or (db['Name'] in db_list)):
                 print (f"Database {db['Name']} matched with list of databases to be extracted")
-                col_to_be_removed = ['CreateTime', 'CatalogId','VersionId']
-                _db = [db.pop(key, '') for key in col_to_be_removed]
-                database_data_file.write(f"database\t{db['Name']}\t\t{json.dumps(db)}\n".encode('utf-8'))
-                database_count[db['Name']] += 1
-                for page in table_paginator.paginate(DatabaseName=db['Name']):
-                    for table in page['TableList']:
-                        print(f"Processing table {table['Name']}")
-                        col_to_be_removed = ['CatalogId','DatabaseName','LastAccessTime','CreateTime', 'UpdateTime', 'CreatedBy','IsRegisteredWithLakeFormation','VersionId']
-                        _table = [table.pop(key,'') for key in col_to_be_removed]
-                        database_data_file.write(f"table\t{db['Name']}\t{table['Name']}\t{json.dumps(table)}\n".encode('utf-8'))
-                        table_count[db['Name']] += 1
-                        for partition_page in partition_paginator.paginate(DatabaseName=db['Name'], TableName=table['Name']):
-                            for partition in partition_page['Partitions']:
-                                print(f"Processing partition {partition['Values']} for table {table['Name']}")
-                                col_to_be_removed = ['CatalogId', 'DatabaseName', 'CreationTime', 'LastAccessTime']
-                                _partition = [partition.pop(key,'') for key in col_to_be_removed]
-                                database_data_file.write(f"partition\t{db['Name']}\t{table['Name']}\t{json.dumps(partition)}\n".encode('utf-8'))
-                                partition_count[db['Name']] += 1
-                                for db_name in table_count.keys():
-                                    print(f"{db_name}=>table_count:{table_count[db_name]}")
-                                    print (f"database_data_file.name => {database_data_file}")
-                                    print(f"Extracted database count => {len(list(database_count.keys()))}  total table count => {len(list(table_count.elements()))}")
-        # Once all databases are processed, upload the consolidated data to S3
-        database_data_file.close()
-        with open(database_data_file.name, 'rb') as file_for_upload:
-            wr.s3.upload(local_file=file_for_upload, path=output_file_name)
-            print(f"Stored consolidated data in {database_data_file}")
-        os.remove(database_data_file.name)
+                databases.append(db)
+    # Every worker streams into the same multipart upload. A table line is written before the partitions of the
+    # table are submitted, so the restore always reads a database before its tables and a table before its partitions.
+    s3_client = get_client(source_region, 's3', max_pool_connections=worker_count)
+    partition_futures = {}
+    table_watermarks = {}
+    with CatalogWriter(s3_client, output_file_name, backup_format, serializer) as catalog_file, \
+            ThreadPoolExecutor(max_workers=worker_count) as executor:
+        extract_table_partitions = partial(extract_partitions, glue_client, catalog_file=catalog_file,
+                                           segment_count=segment_count, segment_threshold=segment_threshold)
+        db_tables = executor.map(partial(list_tables, glue_client), [db['Name'] for db in databases])
+        for db, tables in zip(databases, db_tables):
+            _db = [db.pop(key, '') for key in database_keys_to_be_removed]
+            catalog_file.write([('database', db['Name'], '', db)])
+            database_count[db['Name']] += 1
+            db_watermarks = table_watermarks.setdefault(db['Name'], {})
+            for table in tables:
+                watermark = [table['UpdateTime'].isoformat() if 'UpdateTime' in table else None, table.get('VersionId')]
+                db_watermarks[table['Name']] = watermark
+                if previous_watermarks is not None and previous_watermarks.get(db['Name'], {}).get(table['Name']) == watermark:
+                    if scan_unchanged_partitions:
+                        # The table line is not in the delta, so its new partitions are written in full
+                        future = executor.submit(extract_table_partitions, db['Name'], table['Name'], created_after=created_after)
+                        partition_futures[future] = (db['Name'], table['Name'], None, created_after)
+                    continue
+                print(f"Processing table {table['Name']}")
+                _table = [table.pop(key,'') for key in table_keys_to_be_removed]
+                catalog_file.write([('table', db['Name'], table['Name'], table)])
+                table_count[db['Name']] += 1
+                table_storage_descriptor = table.get('StorageDescriptor', {}) if partition_encoding == 'delta' else None
+                future = executor.submit(extract_table_partitions, db['Name'], table['Name'], table_storage_descriptor=table_storage_descriptor)
+                partition_futures[future] = (db['Name'], table['Name'], table_storage_descriptor, None)
+        while partition_futures:
+            done, _ = wait(partition_futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                db_name, table_name, table_storage_descriptor, partitions_created_after = partition_futures.pop(future)
+                extracted_count = future.result()
+                if extracted_count is None:
+                    print(f"Table {db_name}.{table_name} has more than {segment_threshold} partitions, scanning it in {segment_count} parallel segments")
+                    for segment in range(segment_count):
+                        future = executor.submit(extract_table_partitions, db_name, table_name, segment=segment,
+                                                 table_storage_descriptor=table_storage_descriptor,
+                                                 created_after=partitions_created_after)
+                        partition_futures[future] = (db_name, table_name, table_storage_descriptor, partitions_created_after)
+                else:
+                    partition_count[db_name] += extracted_count
+    for db_name in database_count.keys():
+        print(f"{db_name}=>table_count:{table_count[db_name]} partition_count:{partition_count[db_name]}")
+    print(f"Extracted database count => {len(list(database_count.keys()))}  total table count => {sum(table_count.values())}  partition count => {sum(partition_count.values())}")
+    print(f"Stored consolidated data in {output_file_name}")
+    return table_watermarks
+
+def get_manifest_path(config, data_source):
+    output_file_name = config[data_source]['s3_data_path']
+    return config.get(data_source, 'watermark_manifest_path', fallback=output_file_name.rstrip('/') + '.manifest.json')
+
+def get_watermark_manifest(s3_client, manifest_path):
+    bucket, key = split_s3_path(manifest_path)
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+def put_watermark_manifest(s3_client, manifest_path, manifest):
+    bucket, key = split_s3_path(manifest_path)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+
+class SyncCheckpoint:
+    """Progress of the sync of one data source, stored in the backup bucket so that a rerun skips the finished work.
+
+    Each phase keeps its own state. A checkpoint written with a different configuration, or created more than
+    max_age_hours ago, is ignored so that a later scheduled run never restores the backup and the permission files
+    of an old run. The checkpoint is deleted once every phase of the data source succeeded."""
+
+    def __init__(self, s3_client, s3_path, config_fingerprint, enabled=True, max_age_hours=12):
+        self.s3_client = s3_client
+        self.s3_path = s3_path
+        self.config_fingerprint = config_fingerprint
+        self.enabled = enabled
+        self.max_age_hours = max_age_hours
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+        self.created_at = time.time()
+        self.phases = self._load() if enabled else {}
+
+    def _load(self):
+        bucket, key = split_s3_path(self.s3_path)
+        try:
+            checkpoint = json.loads(self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+        except self.s3_client.exceptions.NoSuchKey:
+            return {}
+        if checkpoint.get('config') != self.config_fingerprint:
+            print(f"Ignoring checkpoint {self.s3_path}, it was written with a different configuration")
+            return {}
+        age_hours = (self.created_at - checkpoint.get('created_at', 0)) / 3600
+        if age_hours > self.max_age_hours:
+            print(f"Ignoring checkpoint {self.s3_path}, its run started {age_hours:.1f} hours ago")
+            return {}
+        # The age of a resumed run still counts from the start of the interrupted run
+        self.created_at = checkpoint['created_at']
+        print(f"Resuming from checkpoint {self.s3_path} => {sorted(checkpoint['phases'])}")
+        return checkpoint['phases']
+
+    def get(self, phase):
+        with self._lock:
+            return dict(self.phases.get(phase, {}))
+
+    def update(self, phase, **values):
+        with self._lock:
+            self.phases.setdefault(phase, {}).update(values)
+
+    def save(self, force=True):
+        """Writes the checkpoint, at most once every CHECKPOINT_INTERVAL seconds unless force is set."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if not force and time.time() - self._saved_at < CHECKPOINT_INTERVAL:
+                return
+            self._saved_at = time.time()
+            body = json.dumps({'config': self.config_fingerprint, 'created_at': self.created_at, 'phases': self.phases}).encode('utf-8')
+        bucket, key = split_s3_path(self.s3_path)
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+
+    def clear(self):
+        if self.enabled:
+            bucket, key = split_s3_path(self.s3_path)
+            self.s3_client.delete_object(Bucket=bucket, Key=key)
+        self.phases = {}
+
+def get_checkpoint(config, data_source):
+    output_file_name = config[data_source]['s3_data_path']
+    checkpoint_path = config.get(data_source, 'checkpoint_path', fallback=output_file_name.rstrip('/') + '.checkpoint.json')
+    # A change to what the run replicates invalidates the checkpoint, performance settings may change between runs
+    checkpoint_sections = [data_source, 'Operation', 'Target_s3_update', 'Remap', 'LakeFormationPermissions']
+    config_fingerprint = get_fingerprint({section: dict(config[section]) for section in checkpoint_sections
+                                          if config.has_section(section)}).hex()
+    return SyncCheckpoint(get_client(config['AwsDataCatalog']['source_region'], 's3'), checkpoint_path, config_fingerprint,
+                          config.getboolean('Operation', 'resume_from_checkpoint', fallback=True),
+                          config.getfloat('Operation', 'checkpoint_max_age_hours', fallback=12))
+
+def extract_catalog(config, data_source, source_region, db_list):
+    """Runs a full or incremental extract for data_source. Returns the backup paths the restore has to apply and, in
+    incremental mode, the advanced watermark manifest, which is only stored once the restore succeeded."""
+    output_file_name = config[data_source]['s3_data_path']
+    extract_mode = config.get(data_source, 'extract_mode', fallback='full')
+    manifest_path = get_manifest_path(config, data_source)
+    extract_args = {
+        'worker_count': config.getint('Performance', 'extract_worker_count', fallback=8),
+        # GetPartitions accepts at most 10 segments and 1000 partitions per page
+        'segment_count': min(config.getint('Performance', 'partition_segment_count', fallback=4), 10),
+        'segment_threshold': min(config.getint('Performance', 'partition_segment_threshold', fallback=1000), 1000),
+        'backup_format': config.get(data_source, 'backup_format', fallback='tsv'),
+        'partition_encoding': config.get(data_source, 'partition_encoding', fallback='full'),
+        'serializer': get_serializer(config.get('Performance', 'serializer', fallback='auto')),
+    }
+    s3_client = get_client(source_region, 's3')
+    run_time = datetime.datetime.now(datetime.timezone.utc)
+    manifest = get_watermark_manifest(s3_client, manifest_path) if extract_mode == 'incremental' else None
+    if manifest is None:
+        if extract_mode == 'incremental':
+            print(f"No watermark manifest found at {manifest_path}, running a full extract")
+        table_watermarks = extract_database(source_region, output_file_name, db_list, **extract_args)
+        manifest = {'snapshot': output_file_name, 'deltas': [], 'extract_time': run_time.isoformat(), 'tables': table_watermarks}
+        restore_paths = [output_file_name]
+    else:
+        delta_file_name = f"{output_file_name.rstrip('/')}.delta/{run_time.strftime('%Y%m%d%H%M%S')}"
+        print(f"Extracting tables changed since {manifest['extract_time']} to {delta_file_name}")
+        table_watermarks = extract_database(source_region, delta_file_name, db_list,
+                                            previous_watermarks=manifest['tables'],
+                                            created_after=datetime.datetime.fromisoformat(manifest['extract_time']),
+                                            scan_unchanged_partitions=config.getboolean(data_source, 'incremental_partition_scan', fallback=False),
+                                            **extract_args)
+        manifest['deltas'].append(delta_file_name)
+        manifest['extract_time'] = run_time.isoformat()
+        # Only the tables still in the source keep a watermark, dropped tables leave the compare index with it
+        manifest['tables'] = table_watermarks
+        if config.getboolean(data_source, 'restore_from_snapshot', fallback=False):
+            restore_paths = [manifest['snapshot']] + manifest['deltas']
+        else:
+            restore_paths = [delta_file_name]
+    return restore_paths, manifest if extract_mode == 'incremental' else None
+
+def summarize_table(table, partition_count=None):
+    storage_descriptor = table.get('StorageDescriptor', {})
+    return {
+        'columns': {column['Name']: column.get('Type') for column in storage_descriptor.get('Columns', [])},
+        'partition_keys': [(column['Name'], column.get('Type')) for column in table.get('PartitionKeys', [])],
+        'location': storage_descriptor.get('Location'),
+        'partition_count': partition_count,
+    }
+
+def count_partitions(glue_client, db_name, table_name):
+    partition_paginator = glue_client.get_paginator("get_partitions")
+    return sum(len(page['Partitions']) for page in partition_paginator.paginate(
+        DatabaseName=db_name, TableName=table_name, ExcludeColumnSchema=True, PaginationConfig={'PageSize': 1000}))
+
+def get_glue_catalog_index(glue_client, db_list=None, worker_count=8, with_partition_counts=True):
+    """Returns {(database, table): summary} of a catalog, reading the tables of its databases in parallel."""
+    db_paginator = glue_client.get_paginator("get_databases")
+    db_names = [db['Name'] for page in db_paginator.paginate() for db in page['DatabaseList']
+                if db_list is None or db['Name'] in db_list]
+    catalog_index = {}
+    count_futures = {}
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        for db_name, tables in zip(db_names, executor.map(partial(list_tables, glue_client), db_names)):
+            for table in tables:
+                catalog_index[(db_name, table['Name'])] = summarize_table(table, 0 if with_partition_counts else None)
+                if with_partition_counts and table.get('PartitionKeys'):
+                    count_futures[(db_name, table['Name'])] = executor.submit(count_partitions, glue_client, db_name, table['Name'])
+        for key, future in count_futures.items():
+            catalog_index[key]['partition_count'] = future.result()
+    return catalog_index
+
+def get_extract_catalog_index(s3_client, s3_paths, backup_format='tsv', db_list=None, table_watermarks=None):
+    """Returns {(database, table): summary} of a catalog backup, applying the backup files in s3_paths in order.
+
+    Deltas never record deletions, so with the table_watermarks of the manifest the tables missing from it are dropped."""
+    catalog_index = {}
+    for s3_path in s3_paths:
+        for object_type, db_name, object_name, data in read_catalog_records(s3_client, s3_path, backup_format, db_list):
+            if object_type == 'table':
+                # A table line is followed by every partition of the table, the partitions of a previous file are replaced
+                catalog_index[(db_name, object_name)] = summarize_table(data, 0)
+            elif object_type == 'partition' and (db_name, object_name) in catalog_index:
+                catalog_index[(db_name, object_name)]['partition_count'] += 1
+    if table_watermarks is not None:
+        catalog_index = {(db_name, table_name): summary for (db_name, table_name), summary in catalog_index.items()
+                         if table_name in table_watermarks.get(db_name, {})}
+    return catalog_index
+
+def get_table_differences(source_summary, target_summary):
+    differences = []
+    for column_name, column_type in source_summary['columns'].items():
+        if column_name not in target_summary['columns']:
+            differences.append(f"column {column_name} missing in target")
+        elif target_summary['columns'][column_name] != column_type:
+            differences.append(f"column {column_name} is {column_type} in source and {target_summary['columns'][column_name]} in target")
+    for column_name in target_summary['columns']:
+        if column_name not in source_summary['columns']:
+            differences.append(f"column {column_name} only in target")
+    if source_summary['partition_keys'] != target_summary['partition_keys']:
+        differences.append(f"partition keys {source_summary['partition_keys']} in source and {target_summary['partition_keys']} in target")
+    if source_summary['location'] != target_summary['location']:
+        differences.append(f"location {source_summary['location']} in source and {target_summary['location']} in target")
+    if None not in (source_summary['partition_count'], target_summary['partition_count']) and \
+            source_summary['partition_count'] != target_summary['partition_count']:
+        differences.append(f"{source_summary['partition_count']} partitions in source and {target_summary['partition_count']} in target")
+    return differences
+
+def diff_catalog_indexes(source_index, target_index):
+    catalog_diff = {'matched': [], 'changed': {}, 'source_only': [], 'target_only': []}
+    for key in sorted(source_index.keys() | target_index.keys()):
+        if key not in target_index:
+            catalog_diff['source_only'].append(key)
+        elif key not in source_index:
+            catalog_diff['target_only'].append(key)
+        else:
+            differences = get_table_differences(source_index[key], target_index[key])
+            if differences:
+                catalog_diff['changed'][key] = differences
+            else:
+                catalog_diff['matched'].append(key)
+    return catalog_diff
+
+def get_extract_paths(config, data_source):
+    """Returns the backup paths of data_source and, for an incremental extract, the table watermarks of its manifest."""
+    output_file_name = config[data_source]['s3_data_path']
+    if config.get(data_source, 'extract_mode', fallback='full') == 'incremental':
+        manifest = get_watermark_manifest(get_client(config[data_source]['source_region'], 's3'), get_manifest_path(config, data_source))
+        if manifest is not None:
+            return [manifest['snapshot']] + manifest['deltas'], manifest['tables']
+    return [output_file_name], None
 
 def compare_db_tables(config, data_source):
     source_region = config[data_source]['source_region']
     destination_region = config[data_source]['destination_region']
     output_file_name = config[data_source]['s3_data_path']
     db_list = ast.literal_eval(config[data_source]['database_list'])
+    index_db_list = None if db_list == ['ALL_DATABASE'] else db_list
+    compare_source = config.get(data_source, 'compare_source', fallback='glue')
+    with_partition_counts = config.getboolean(data_source, 'compare_partition_counts', fallback=True)
+    worker_count = config.getint('Performance', 'extract_worker_count', fallback=8)
     start_time = time.time()
     print(f"Starting processing at {time.asctime(time.localtime(time.time()))} with the following parameters ")
     print(f"datasource => {data_source}")
     print(f"source region name => {source_region}")
     print(f"database => {db_list}")
     print(f"output_file_name => {output_file_name}")
+    print(f"compare source => {compare_source}")
     print("=============================================================================")
-    source_tables_df = get_tables(source_region, data_source, db_list)
-    destination_tables_df = get_tables(destination_region, data_source, db_list)
-    matched_df, source_only_df, target_only_df = compare_df(source_tables_df, destination_tables_df, df_index)
+    if compare_source == 'extract':
+        extract_paths, table_watermarks = get_extract_paths(config, data_source)
+        source_index = get_extract_catalog_index(get_client(source_region, 's3'), extract_paths,
+                                                 config.get(data_source, 'backup_format', fallback='tsv'), index_db_list, table_watermarks)
+    else:
+        source_index = get_glue_catalog_index(get_client(source_region, 'glue', max_pool_connections=worker_count),
+                                              index_db_list, worker_count, with_partition_counts)
+    target_index = get_glue_catalog_index(get_client(destination_region, 'glue', max_pool_connections=worker_count),
+                                          index_db_list, worker_count, with_partition_counts)
+    # Compare against the locations the restore writes to the target, remapped first and then mapped
+    remapper = get_catalog_remapper(config)
+    update_table_s3_location = config.getboolean('Target_s3_update', 'update_table_s3_location', fallback=False)
+    table_s3_mapping = LocationMapper(ast.literal_eval(config.get('AwsDataCatalog', 'target_s3_locations')))
+    for summary in source_index.values():
+        summary['location'] = remapper.remap_location(summary['location'])
+        if update_table_s3_location:
+            summary['location'] = update_location(summary['location'], table_s3_mapping)
+    catalog_diff = diff_catalog_indexes(source_index, target_index)
+    catalog_diff['source_index'] = source_index
+    catalog_diff['target_index'] = target_index
     print("=" * 50)
-    if not matched_df.dropna().empty:
+    if catalog_diff['matched']:
         print("Matched Tables")
-        print(matched_df[df_index].to_string(index=False))
+        for db_name, table_name in catalog_diff['matched']:
+            print(f"{db_name}.{table_name}")
     else:
         print ("No tables are matched")
     print("-" * 50)
-    if not source_only_df.dropna().empty:
+    if catalog_diff['changed']:
+        print("Changed Tables")
+        for (db_name, table_name), differences in catalog_diff['changed'].items():
+            print(f"{db_name}.{table_name} => {'; '.join(differences)}")
+    else:
+        print ("No tables are changed")
+    print("-" * 50)
+    if catalog_diff['source_only']:
         print("Source only tables")
-        print(source_only_df[df_index].to_string(index=False)) if not source_only_df.empty else print(
-        "All tables copied, no tables in source left")
+        for db_name, table_name in catalog_diff['source_only']:
+            print(f"{db_name}.{table_name}")
     else:
-        print ("No tables are found in the source")
+        print ("All tables copied, no tables in source left")
     print("-" * 50)
-    if not target_only_df.dropna().empty:
+    if catalog_diff['target_only']:
         print("Target only tables")
-        print(target_only_df[df_index].to_string(index=False)) if not target_only_df.empty else print(
-        "All tables copied, no addiitonal tables in  tables left")
+        for db_name, table_name in catalog_diff['target_only']:
+            print(f"{db_name}.{table_name}")
     else:
-        print ("No tables are found in the target region")
+        print ("No additional tables are found in the target region")
     print("-" * 50)
+    print(f"Compared {len(source_index)} source tables with {len(target_index)} target tables in {int(time.time() - start_time)} secs")
+
+    return catalog_diff
 
-    return matched_df, source_only_df, target_only_df
+def get_chunks(items, chunk_size):
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
 
-def delete_target_tables(config, data_source):
-    matched_df, source_only_df, target_only_df = compare_db_tables(config, data_source)
-    tables_to_deleted = target_only_df
-    #TODO  : delete tables
+def list_partition_values(glue_client, db_name, table_name):
+    partition_paginator = glue_client.get_paginator("get_partitions")
+    return {tuple(partition['Values']) for page in partition_paginator.paginate(
+        DatabaseName=db_name, TableName=table_name, ExcludeColumnSchema=True, PaginationConfig={'PageSize': 1000})
+            for partition in page['Partitions']}
+
+def delete_tables(glue_client, db_name, table_names, dry_run=True):
+    failed_count = 0
+    for table_chunk in get_chunks(table_names, TABLE_DELETE_BATCH_SIZE):
+        if dry_run:
+            print(f"Dry run, would delete tables {table_chunk} from database {db_name}")
+            continue
+        response = glue_client.batch_delete_table(DatabaseName=db_name, TablesToDelete=table_chunk)
+        for error in response.get('Errors', []):
+            if error['ErrorDetail']['ErrorCode'] != 'EntityNotFoundException':
+                print(f"Failed to delete table {db_name}.{error['TableName']}. Reason: {error['ErrorDetail']}")
+                failed_count += 1
+        print(f"Deleted tables {table_chunk} from database {db_name}")
+    return failed_count
+
+def delete_orphan_partitions(source_glue_client, target_glue_client, db_name, table_name, dry_run=True):
+    orphan_values = sorted(list_partition_values(target_glue_client, db_name, table_name) -
+                           list_partition_values(source_glue_client, db_name, table_name))
+    failed_count = 0
+    for partition_chunk in get_chunks(orphan_values, PARTITION_DELETE_BATCH_SIZE):
+        if dry_run:
+            print(f"Dry run, would delete partitions {[list(values) for values in partition_chunk]} of {db_name}.{table_name}")
+            continue
+        response = target_glue_client.batch_delete_partition(DatabaseName=db_name, TableName=table_name,
+                                                             PartitionsToDelete=[{'Values': list(values)} for values in partition_chunk])
+        for error in response.get('Errors', []):
+            if error['ErrorDetail']['ErrorCode'] != 'EntityNotFoundException':
+                print(f"Failed to delete partition {error['PartitionValues']} of {db_name}.{table_name}. Reason: {error['ErrorDetail']}")
+                failed_count += 1
+    if orphan_values:
+        print(f"{'Found' if dry_run else 'Deleted'} {len(orphan_values)} orphaned partitions of {db_name}.{table_name}")
+    return len(orphan_values), failed_count
+
+def delete_target_tables(config, data_source, checkpoint=None, restored=False):
+    """Deletes the target tables missing in the source and the orphaned partitions of the other target tables.
+
+    restored tells that the restore of this job already wrote every source partition to the target."""
+    catalog_diff = compare_db_tables(config, data_source)
+    dry_run = config.getboolean('Operation', 'delete_dry_run', fallback=True)
+    worker_count = config.getint('Performance', 'restore_worker_count', fallback=8)
+    source_glue_client = get_client(config[data_source]['source_region'], 'glue', max_pool_connections=worker_count)
+    target_glue_client = get_client(config[data_source]['destination_region'], 'glue', max_pool_connections=worker_count)
+    tables_to_deleted = {}
+    for db_name, table_name in catalog_diff['target_only']:
+        tables_to_deleted.setdefault(db_name, []).append(table_name)
+    # Tables kept in the target may still hold partitions that no longer exist in the source. Once the restore has
+    # run a table can only hold orphans when its partition count differs, so only those tables are listed. Without a
+    # restore equal counts can hide different partition values, so every partitioned table is listed.
+    tables_to_check = []
+    for key in catalog_diff['matched'] + list(catalog_diff['changed']):
+        source_summary, target_summary = catalog_diff['source_index'][key], catalog_diff['target_index'][key]
+        if target_summary['partition_keys'] and (not restored
+                                                 or None in (source_summary['partition_count'], target_summary['partition_count'])
+                                                 or source_summary['partition_count'] != target_summary['partition_count']):
+            tables_to_check.append(key)
+    completed_databases = set(checkpoint.get('delete').get('completed_databases', [])) if checkpoint and not dry_run else set()
+    if completed_databases:
+        print(f"Skipping databases already cleaned up according to the checkpoint => {sorted(completed_databases)}")
+    print(f"{'Dry run, reporting' if dry_run else 'Deleting'} {len(catalog_diff['target_only'])} target only tables "
+          f"and the orphaned partitions of {len(tables_to_check)} tables")
+    failed_count = 0
+    orphan_count = 0
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        table_futures = {executor.submit(delete_tables, target_glue_client, db_name, table_names, dry_run): db_name
+                         for db_name, table_names in tables_to_deleted.items() if db_name not in completed_databases}
+        partition_futures = {executor.submit(delete_orphan_partitions, source_glue_client, target_glue_client, db_name, table_name, dry_run): db_name
+                             for db_name, table_name in tables_to_check if db_name not in completed_databases}
+        remaining_tasks = Counter([*table_futures.values(), *partition_futures.values()])
+        failed_databases = set()
+        for future in as_completed([*table_futures, *partition_futures]):
+            if future in table_futures:
+                db_name, db_failed_count = table_futures[future], future.result()
+            else:
+                db_name, (orphan_partition_count, db_failed_count) = partition_futures[future], future.result()
+                orphan_count += orphan_partition_count
+            failed_count += db_failed_count
+            if db_failed_count:
+                failed_databases.add(db_name)
+            remaining_tasks[db_name] -= 1
+            # A database is only recorded once all of its deletions succeeded
+            if checkpoint and not dry_run and remaining_tasks[db_name] == 0 and db_name not in failed_databases:
+                completed_databases.add(db_name)
+                checkpoint.update('delete', completed_databases=sorted(completed_databases))
+                checkpoint.save(force=False)
+    if checkpoint and not dry_run:
+        checkpoint.save()
+    print(f"{'Would delete' if dry_run else 'Deleted'} {len(catalog_diff['target_only'])} target only tables and {orphan_count} orphaned partitions")
+    if failed_count:
+        raise RuntimeError(f"{failed_count} target catalog objects could not be deleted")
 
 def main():
     global source_session
@@ -310,14 +1435,20 @@ def main():
     delete_target_catalog_objects = config.getboolean('Operation', 'delete_target_catalog_objects')
     sync_glue_catalog = config.getboolean('Operation','sync_glue_catalog')
     sync_lf_permissions = config.getboolean('Operation', 'sync_lf_permissions')
+    sync_lf_tags_enabled = config.getboolean('Operation', 'sync_lf_tags', fallback=False)
+    sync_data_cells_filters_enabled = config.getboolean('Operation', 'sync_data_cells_filters', fallback=False)
     update_table_s3_location = config.getboolean('Target_s3_update','update_table_s3_location')
-    table_s3_mapping = ast.literal_eval(config.get('AwsDataCatalog','target_s3_locations'))
+    table_s3_mapping = LocationMapper(ast.literal_eval(config.get('AwsDataCatalog','target_s3_locations')))
     list_datasource = ast.literal_eval(config.get('ListCatalog','list_datasource'))
 
     print(f"Received list of data sources {list_datasource}")
-    source_lf_client = get_client(config['AwsDataCatalog']['source_region'],'lakeformation')
-    destination_lf_client = get_client(config['AwsDataCatalog']['destination_region'],'lakeformation')
-    glue_client = get_client(config['AwsDataCatalog']['destination_region'], 'glue')
+    permission_worker_count = config.getint('Performance', 'permission_worker_count', fallback=4)
+    revoke_extra_permissions = config.getboolean('LakeFormationPermissions', 'revoke_extra_permissions', fallback=False)
+    remapper = get_catalog_remapper(config)
+    source_lf_client = get_client(config['AwsDataCatalog']['source_region'],'lakeformation', max_pool_connections=permission_worker_count)
+    destination_lf_client = get_client(config['AwsDataCatalog']['destination_region'],'lakeformation', max_pool_connections=permission_worker_count)
+    restore_worker_count = config.getint('Performance', 'restore_worker_count', fallback=8)
+    glue_client = get_client(config['AwsDataCatalog']['destination_region'], 'glue', max_pool_connections=restore_worker_count)
 
     for data_source in list_datasource:
         source_region = config['AwsDataCatalog']['source_region']
@@ -329,6 +1460,8 @@ def main():
 
         db_list = ast.literal_eval(config[data_source]['database_list'])
 
+        checkpoint = get_checkpoint(config, data_source)
+
         if sync_glue_catalog:
             print(f"Starting processing at {time.asctime(time.localtime(time.time()))} with the following parameters ")
             print(f"datasource => {data_source}")
@@ -336,19 +1469,48 @@ def main():
             print(f"database => {db_list}")
             print(f"output_file_name => {output_file_name}")
             print("=============================Starting Processing ================================================")
-            extract_database(source_region, output_file_name, db_list)
-            restore_data(config, data_source, glue_client,update_table_s3_location, table_s3_mapping)
+            extract_state = checkpoint.get('extract')
+            if extract_state.get('done'):
+                # Reuse the backup of the interrupted run together with the manifest it has not stored yet
+                restore_paths, manifest = extract_state['restore_paths'], extract_state.get('manifest')
+                print(f"Extract already completed according to the checkpoint, restoring {restore_paths}")
+            else:
+                restore_paths, manifest = extract_catalog(config, data_source, source_region, db_list)
+                checkpoint.update('extract', done=True, restore_paths=restore_paths, manifest=manifest)
+                checkpoint.save()
+            restore_data(config, data_source, glue_client,update_table_s3_location, table_s3_mapping, restore_paths, checkpoint)
+            if manifest is not None:
+                # The watermarks only advance once their delta is restored, so the next run extracts a failed delta again
+                manifest_path = get_manifest_path(config, data_source)
+                put_watermark_manifest(get_client(source_region, 's3'), manifest_path, manifest)
+                print(f"Stored watermark manifest in {manifest_path}")
 
         if delete_target_catalog_objects:
-            delete_target_tables(config, data_source)
+            delete_target_tables(config, data_source, checkpoint, restored=sync_glue_catalog)
+
 
+        if sync_lf_tags_enabled and not checkpoint.get('lf_tags').get('done'):
+            sync_lf_tags(source_lf_client, destination_lf_client, db_list, lf_storage_bucket, lf_storage_folder, lf_storage_file_name, permission_worker_count, remapper)
+            checkpoint.update('lf_tags', done=True)
+            checkpoint.save()
+
+        if sync_data_cells_filters_enabled and not checkpoint.get('data_cells_filters').get('done'):
+            sync_data_cells_filters(source_lf_client, destination_lf_client, db_list, permission_worker_count)
+            checkpoint.update('data_cells_filters', done=True)
+            checkpoint.save()
 
         if sync_lf_permissions:
-            permission_data = get_permissions(source_lf_client)
-            store_permission_data(permission_data,source_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name)
-            permission_data = get_permissions(destination_lf_client)
-            store_permission_data(permission_data,target_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name)
-            apply_table_permissions(f"{config['LakeFormationPermissions']['lf_storage_file_name']}", destination_lf_client, db_list,source_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name)
+            # The stored permission files are only reused together with the batch cursors computed from them
+            if not checkpoint.get('permissions').get('dumped'):
+                permission_data = get_permissions(source_lf_client, db_list, permission_worker_count)
+                store_permission_data(permission_data,source_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name, permission_worker_count)
+                permission_data = get_permissions(destination_lf_client, db_list, permission_worker_count)
+                store_permission_data(permission_data,target_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name, permission_worker_count)
+                checkpoint.update('permissions', dumped=True)
+                checkpoint.save()
+            apply_table_permissions(f"{config['LakeFormationPermissions']['lf_storage_file_name']}", destination_lf_client, db_list,source_region,lf_storage_bucket,lf_storage_folder,lf_storage_file_name, permission_worker_count, revoke_extra_permissions, remapper, checkpoint)
+
+        checkpoint.clear()
     end_time = time.time()
     execution_time = end_time - start_time
     print(f"Processing finished in {int(execution_time)} secs")
@@ -0,0 +1,182 @@
+"""Serializers for the catalog backup records and the permission files of the replication job.
+
+orjson is used when it is installed and the standard json module otherwise. Both write plain JSON, so a backup
+written with one backend can be restored with the other. Partitions can be stored as a delta against the storage
+descriptor of their table, and Lake Formation permissions are compared as canonical permission keys."""
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SERIALIZERS = ['auto', 'json', 'orjson']
+
+CatalogRecord = namedtuple('CatalogRecord', ['object_type', 'database', 'name', 'data'])
+
+# json.dumps builds a new encoder for every call that passes default, a shared one keeps its fast path
+json_encoder = json.JSONEncoder(default=str)
+
+
+class JsonSerializer:
+    """Standard library backend. Records are encoded as one str per batch and converted to bytes once."""
+
+    name = 'json'
+
+    def dumps(self, data):
+        return json_encoder.encode(data).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode_tsv(self, records):
+        return ''.join(f"{object_type}\t{db_name}\t{object_name}\t{json_encoder.encode(data)}\n"
+                       for object_type, db_name, object_name, data in records).encode('utf-8')
+
+    def encode_jsonl(self, records):
+        return ''.join(json_encoder.encode({'object_type': object_type, 'database': db_name, 'name': object_name, 'data': data}) + "\n"
+                       for object_type, db_name, object_name, data in records).encode('utf-8')
+
+    def decode_tsv(self, line, db_list=None):
+        """Returns the record of a tsv line, or None without parsing its JSON when its database is not in db_list."""
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        object_type, db_name, object_name, data = line.rstrip('\n').split('\t', 3)
+        if db_list is not None and db_name not in db_list:
+            return None
+        return CatalogRecord(object_type, db_name, object_name, self.loads(data))
+
+    def decode_jsonl(self, line, db_list=None):
+        record = self.loads(line)
+        if db_list is not None and record['database'] not in db_list:
+            return None
+        return CatalogRecord(record['object_type'], record['database'], record['name'], record['data'])
+
+
+class OrjsonSerializer(JsonSerializer):
+    """orjson backend. Documents are produced and parsed as bytes, lines are never decoded as a whole."""
+
+    name = 'orjson'
+
+    def dumps(self, data):
+        return orjson.dumps(data, default=str)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def encode_tsv(self, records):
+        return b''.join(b'%s\t%s\t%s\t%s\n' % (object_type.encode('utf-8'), db_name.encode('utf-8'), object_name.encode('utf-8'),
+                                               orjson.dumps(data, default=str))
+                        for object_type, db_name, object_name, data in records)
+
+    def encode_jsonl(self, records):
+        return b''.join(orjson.dumps({'object_type': object_type, 'database': db_name, 'name': object_name, 'data': data},
+                                     default=str, option=orjson.OPT_APPEND_NEWLINE)
+                        for object_type, db_name, object_name, data in records)
+
+    def decode_tsv(self, line, db_list=None):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        object_type, db_name, object_name, data = line.rstrip(b'\n').split(b'\t', 3)
+        db_name = db_name.decode('utf-8')
+        if db_list is not None and db_name not in db_list:
+            return None
+        return CatalogRecord(object_type.decode('utf-8'), db_name, object_name.decode('utf-8'), orjson.loads(data))
+
+
+def encode_partition_delta(partition, table_storage_descriptor):
+    # Only the values, the location below the table location and the storage descriptor fields that differ from
+    # the table are kept, decode_partition_delta rebuilds the full partition from the table storage descriptor
+    if 'StorageDescriptor' not in partition:
+        return partition
+    storage_descriptor = partition.pop('StorageDescriptor')
+    location = storage_descriptor.get('Location')
+    table_location = table_storage_descriptor.get('Location') or ''
+    location_prefix = table_location if table_location.endswith('/') else table_location + '/'
+    delta = {key: value for key, value in storage_descriptor.items()
+             if key != 'Location' and table_storage_descriptor.get(key) != value}
+    if location is not None and table_location and location.startswith(location_prefix):
+        partition['LocationSuffix'] = location[len(location_prefix):]
+    elif location is not None:
+        delta['Location'] = location
+    removed_keys = [key for key in table_storage_descriptor if key != 'Location' and key not in storage_descriptor]
+    if removed_keys:
+        partition['StorageDescriptorRemovedKeys'] = removed_keys
+    partition['StorageDescriptorDelta'] = delta
+    return partition
+
+
+def decode_partition_delta(partition_data, table_storage_descriptor):
+    if 'StorageDescriptorDelta' not in partition_data:
+        return partition_data
+    removed_keys = partition_data.pop('StorageDescriptorRemovedKeys', [])
+    storage_descriptor = {key: value for key, value in table_storage_descriptor.items() if key not in removed_keys}
+    storage_descriptor.pop('Location', None)
+    storage_descriptor.update(partition_data.pop('StorageDescriptorDelta'))
+    if 'LocationSuffix' in partition_data:
+        table_location = table_storage_descriptor.get('Location', '')
+        location_prefix = table_location if table_location.endswith('/') else table_location + '/'
+        storage_descriptor['Location'] = location_prefix + partition_data.pop('LocationSuffix')
+    partition_data['StorageDescriptor'] = storage_descriptor
+    return partition_data
+
+
+def normalize_permission_resource(row):
+    if 'Table' in row['Resource'] and 'Name' in row['Resource']['Table'] and row['Resource']['Table']['Name'] == 'ALL_TABLES':
+        del row['Resource']['Table']['Name']
+        row['Resource']['Table']['TableWildcard'] = {}
+    if 'TableWithColumns' in row['Resource'] and 'Name' in row['Resource']['TableWithColumns'] and row['Resource']['TableWithColumns']['Name'] == 'ALL_TABLES':
+        row['Resource']['Table'] = row['Resource']['TableWithColumns']
+        del row['Resource']['Table']['Name']
+        del row['Resource']['Table']['ColumnWildcard']
+        del row['Resource']['TableWithColumns']
+        row['Resource']['Table']['TableWildcard'] = {}
+    return row
+
+
+def get_permission_keys(row):
+    """Returns the (principal, resource, permission, grantable) keys of a PrincipalResourcePermissions row.
+
+    Principal and resource are canonical JSON strings of the normalized row, so the same grant listed in two regions
+    gives the same keys.
+    """
+    row = normalize_permission_resource(row)
+    principal = json.dumps(row['Principal'], sort_keys=True)
+    resource = json.dumps(row['Resource'], sort_keys=True)
+    grantable_permissions = set(row.get('PermissionsWithGrantOption', []))
+    return {(principal, resource, permission, permission in grantable_permissions)
+            for permission in set(row.get('Permissions', [])) | grantable_permissions}
+
+
+def get_permission_entries(permission_keys):
+    """Groups permission keys back into one BatchGrantPermissions/BatchRevokePermissions entry per principal and resource."""
+    entries = {}
+    for principal, resource, permission, grantable in sorted(permission_keys):
+        entry = entries.setdefault((principal, resource), {'Principal': json.loads(principal), 'Resource': json.loads(resource),
+                                                           'Permissions': [], 'PermissionsWithGrantOption': []})
+        entry['Permissions'].append(permission)
+        if grantable:
+            entry['PermissionsWithGrantOption'].append(permission)
+    return list(entries.values())
+
+
+def get_permission_changes(source_keys, target_keys, revoke_extra_permissions=False):
+    """Returns the grant and the revoke entries that give the target the permission keys of the source.
+
+    A permission whose grant option differs is in both, it is revoked first and granted again with the source grant
+    option. Without revoke_extra_permissions nothing is revoked."""
+    grant_entries = get_permission_entries(source_keys - target_keys)
+    revoke_entries = get_permission_entries(target_keys - source_keys) if revoke_extra_permissions else []
+    return grant_entries, revoke_entries
+
+
+def get_serializer(name='auto'):
+    """Returns the serializer called name, auto picks orjson when it is installed."""
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unsupported serializer {name}, expected one of {SERIALIZERS}")
+    if name == 'orjson' and orjson is None:
+        raise ImportError("serializer orjson needs the orjson module, add it to the --additional-python-modules job argument")
+    if name == 'json' or orjson is None:
+        return JsonSerializer()
+    return OrjsonSerializer()
@@ -44,6 +44,7 @@ class GlueRestoreOnDemandStack(Stack):
                     "s3:GetObjectVersion",
                     "s3:PutObject",
                     "s3:PutObjectAcl",
+                    "s3:AbortMultipartUpload",
                     "s3:GetLifecycleConfiguration",
                     "s3:PutLifecycleConfiguration",
                     "s3:DeleteObject"],
@@ -54,7 +55,7 @@ class GlueRestoreOnDemandStack(Stack):
         script_bucket.grant_read(glue_role)
         # Upload the job script code to S3
         aws_s3_deployment.BucketDeployment(self,"DeployGluePythonScriptFile",destination_bucket=script_bucket,
-            sources=[aws_s3_deployment.Source.asset("./script")])
+            sources=[aws_s3_deployment.Source.asset("./script"), aws_s3_deployment.Source.asset("../common/python")])
         # Create a glue job with the role and the script code
         config_filename = self.node.try_get_context("config_file_name") 
         if not config_filename:
@@ -68,7 +69,8 @@ class GlueRestoreOnDemandStack(Stack):
                 default_arguments={
                     '--CONFIG_BUCKET':config_bucket,
                     '--CONFIG_FILE_KEY': config_filename,
-                    '--additional-python-modules': 'awswrangler == 3.4.0'
+                    '--additional-python-modules': 'awswrangler == 3.4.0,orjson',
+                    '--extra-py-files': "s3://"+script_bucket.bucket_name+"/catalog_serializer.py,s3://"+script_bucket.bucket_name+"/catalog_remapper.py"
                 },
                 glue_version= "4.0",
                 worker_type="G.1X",
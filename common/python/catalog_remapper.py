@@ -0,0 +1,122 @@
+"""Account, principal and S3 location remapping shared by the batch Glue job and the realtime replicate Lambda.
+
+The batch job loads this module with --extra-py-files and the Lambda function from a layer."""
+import ast
+import re
+
+# Catalog object and request keys holding an account id, a principal or an S3 location
+catalog_id_keys = {'CatalogId', 'TableCatalogId'}
+catalog_id_list_keys = {'TrustedResourceOwners'}
+principal_keys = {'DataLakePrincipalIdentifier'}
+location_keys = {'Location', 'LocationUri', 'ResourceArn'}
+
+
+class LocationMapper:
+    """Maps S3 locations and S3 ARNs by the longest bucket or bucket/prefix of a mapping that they start with.
+
+    Prefixes only match whole path components. Lookups are cached per distinct leading path of a location, so the
+    partitions of a table resolve their prefix once instead of being parsed one by one."""
+
+    location_pattern = re.compile(r'^(s3[an]?://|arn:aws[a-z-]*:s3:::)([^/].*)$')
+
+    def __init__(self, mapping=None):
+        self.mapping = {self._strip_location(source): self._strip_location(target) for source, target in (mapping or {}).items()}
+        # Only this many leading path components can take part in a match
+        self.depth = max((source.count('/') + 1 for source in self.mapping), default=0)
+        self._cache = {}
+
+    def __bool__(self):
+        return bool(self.mapping)
+
+    @staticmethod
+    def _strip_location(location):
+        for scheme in ('s3://', 's3a://', 's3n://'):
+            if location.startswith(scheme):
+                location = location[len(scheme):]
+        return location.strip('/')
+
+    def _find_prefix(self, components):
+        for component_count in range(len(components), 0, -1):
+            source = '/'.join(components[:component_count])
+            if source in self.mapping:
+                return source, self.mapping[source]
+        return None
+
+    def map(self, location):
+        if not self.mapping or not location:
+            return location
+        match = self.location_pattern.match(location)
+        if match is None:
+            return location
+        scheme, path = match.groups()
+        components = path.split('/', self.depth)[:self.depth]
+        leading_path = '/'.join(components)
+        if leading_path not in self._cache:
+            self._cache[leading_path] = self._find_prefix(components)
+        prefix = self._cache[leading_path]
+        if prefix is None:
+            return location
+        source, target = prefix
+        return scheme + target + path[len(source):]
+
+
+class CatalogRemapper:
+    """Rewrites the account ids, principals and S3 buckets of catalog and permission requests so that a source
+    catalog can be restored into another account. It applies to the records of a catalog backup as well as to
+    replayed requests.
+
+    The mappings are compiled once, account ids into one regular expression and buckets into a LocationMapper, so
+    remapping a record is a single walk over it."""
+
+    def __init__(self, account_ids=None, principals=None, s3_buckets=None):
+        self.account_ids = dict(account_ids or {})
+        self.principals = dict(principals or {})
+        self.location_mapper = LocationMapper(s3_buckets)
+        self.enabled = bool(self.account_ids or self.principals or self.location_mapper)
+        self._account_pattern = re.compile(r'(?<!\d)(' + '|'.join(map(re.escape, self.account_ids)) + r')(?!\d)') if self.account_ids else None
+        self._principal_cache = {}
+
+    def remap(self, data):
+        if not self.enabled:
+            return data
+        if isinstance(data, dict):
+            return {key: self._remap_value(key, value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [self.remap(value) for value in data]
+        return data
+
+    def _remap_value(self, key, value):
+        if isinstance(value, str):
+            if key in catalog_id_keys:
+                return self.account_ids.get(value, value)
+            if key in principal_keys:
+                return self.remap_principal(value)
+            if key in location_keys:
+                return self.remap_location(value)
+            return value
+        if key in catalog_id_list_keys and isinstance(value, list):
+            return [self.account_ids.get(account_id, account_id) for account_id in value]
+        return self.remap(value)
+
+    def remap_principal(self, principal):
+        """Maps a role ARN or SAML group as a whole, otherwise only the account id inside of it."""
+        if principal not in self._principal_cache:
+            if principal in self.principals:
+                self._principal_cache[principal] = self.principals[principal]
+            elif self._account_pattern is not None:
+                self._principal_cache[principal] = self._account_pattern.sub(lambda match: self.account_ids[match.group(1)], principal)
+            else:
+                self._principal_cache[principal] = principal
+        return self._principal_cache[principal]
+
+    def remap_location(self, location):
+        return self.location_mapper.map(location)
+
+
+def get_catalog_remapper(config, s3_location_mapping=None):
+    """Builds the remapper from the optional [Remap] section of the configuration. s3_location_mapping adds bucket
+    or bucket/prefix mappings to the s3_buckets of the section."""
+    def get_mapping(option):
+        return ast.literal_eval(config.get('Remap', option, fallback='{}'))
+    return CatalogRemapper(get_mapping('account_ids'), {**get_mapping('role_arns'), **get_mapping('saml_groups')},
+                           {**(s3_location_mapping or {}), **get_mapping('s3_buckets')})
@@ -3,6 +3,10 @@ import boto3
 import datetime
 import botocore
 import os
+import threading
+import time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
 
@@ -18,6 +22,7 @@ def get_config(s3_config_bucket,s3_config_file):
 dynamodb = boto3.resource('dynamodb')
 
 lake_formation_table = dynamodb.Table('glue_lf_events')
+cursor_table = dynamodb.Table('glue_lf_cloudtrail_cursor')
 
 config_file_bucket = os.environ['config_file_bucket']
 config_file_key = os.environ['config_file_key']
@@ -25,15 +30,55 @@ config = get_config(config_file_bucket,config_file_key)
 
 SOURCE_REGION = config['AwsDataCatalog']['source_region']
 LOOKUP_HOUR_DURATION = int(config['AwsDataCatalog']['cloudtrail_lookup_hour_duration'])
+# Events reach LookupEvents late, every run reads this far back before the end of the previous run
+LOOKUP_OVERLAP_MINUTES = int(config.get('AwsDataCatalog', 'cloudtrail_lookup_overlap_minutes', fallback='15'))
+# Event ids of the overlap kept in the cursor, bounded to stay well below the DynamoDB item size limit
+CURSOR_MAX_EVENT_IDS = 5000
+# The lookup window is split into slices of this many minutes, fetched by concurrent workers
+LOOKUP_SLICE_MINUTES = int(config.get('AwsDataCatalog', 'cloudtrail_lookup_slice_minutes', fallback='10'))
+LOOKUP_WORKER_COUNT = int(config.get('AwsDataCatalog', 'cloudtrail_lookup_worker_count', fallback='4'))
+# LookupEvents allows 2 calls per second per account and region, shared by all workers
+LOOKUP_CALLS_PER_SECOND = float(config.get('AwsDataCatalog', 'cloudtrail_lookup_calls_per_second', fallback='2'))
+# EventSource looks up every event of glue and lakeformation, EventName only the replicated events, one name per lookup
+LOOKUP_ATTRIBUTE = config.get('AwsDataCatalog', 'cloudtrail_lookup_attribute', fallback='EventSource')
+
+# Replicated events per event source
+replicated_events = {
+    'glue.amazonaws.com': ['CreateDatabase', 'DeleteDatabase', 'UpdateDatabase', 'CreateTable', 'BatchCreatePartition', 'UpdateTable',
+                           'DeleteTable'],
+    'lakeformation.amazonaws.com': ['BatchRevokePermissions', 'BatchGrantPermissions', 'CreateLFTag', 'DeleteLFTag', 'UpdateLFTag',
+                                    'GrantPermissions', 'RevokePermissions', 'RegisterResource', 'DeregisterResource',
+                                    'PutDataLakeSettings', 'AddLFTagsToResource', 'CreateDataCellsFilter'],
+}
 
 session = boto3.Session()
-ct_client = session.client('cloudtrail', region_name=SOURCE_REGION)
-
-paginator = ct_client.get_paginator('lookup_events')
-
-start_time = datetime.datetime.now() - datetime.timedelta(hours=LOOKUP_HOUR_DURATION)
-
-print(f"Start time {start_time}")
+ct_client = session.client('cloudtrail', region_name=SOURCE_REGION,
+                           config=Config(max_pool_connections=max(LOOKUP_WORKER_COUNT, 10), retries={'mode': 'adaptive', 'max_attempts': 10}))
+
+
+class TokenBucket:
+    """Rate limiter shared by the lookup workers, allows rate calls per second with bursts of up to capacity calls."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+lookup_rate_limiter = TokenBucket(LOOKUP_CALLS_PER_SECOND)
 
 class DatetimeEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -59,39 +104,104 @@ def is_request_successful(event):
     return False
 
 
+def get_cursor(event_source):
+    """Returns the end of the previous run for event_source and the ids of the events it saw in the overlap."""
+    item = cursor_table.get_item(Key={'EventSource': event_source}).get('Item')
+    if item is None:
+        return None, set()
+    return datetime.datetime.fromisoformat(item['EndTime']), set(item.get('EventIds', []))
+
+def put_cursor(event_source, end_time, event_ids):
+    item = {'EventSource': event_source, 'EndTime': end_time.isoformat()}
+    if event_ids:
+        item['EventIds'] = set(event_ids)
+    cursor_table.put_item(Item=item)
+
+def lookup_events(lookup_attribute, start_time, end_time):
+    """Returns the events of one lookup attribute and time slice, every page call waits for the rate limiter."""
+    events = []
+    request = {'LookupAttributes': [lookup_attribute], 'StartTime': start_time, 'EndTime': end_time, 'MaxResults': 50}
+    while True:
+        lookup_rate_limiter.acquire()
+        response = ct_client.lookup_events(**request)
+        events.extend(response['Events'])
+        if not response.get('NextToken'):
+            return events
+        request['NextToken'] = response['NextToken']
+
+def get_time_slices(start_time, end_time):
+    slice_duration = datetime.timedelta(minutes=LOOKUP_SLICE_MINUTES)
+    slices = []
+    while start_time < end_time:
+        slices.append((start_time, min(start_time + slice_duration, end_time)))
+        start_time += slice_duration
+    return slices
+
+def get_lookup_attributes(event_source):
+    if LOOKUP_ATTRIBUTE == 'EventName':
+        return [{'AttributeKey': 'EventName', 'AttributeValue': event_name} for event_name in replicated_events[event_source]]
+    return [{'AttributeKey': 'EventSource', 'AttributeValue': event_source}]
+
 def lambda_handler(event, context):
-    StartingToken = None
-    for attribte_value in ["glue.amazonaws.com", "lakeformation.amazonaws.com"]:
-        print(f"Attribute value {attribte_value}")
-        page_iterator = paginator.paginate(
-            LookupAttributes=[
-                {'AttributeKey': 'EventSource', 'AttributeValue': attribte_value},
-            ],
-            PaginationConfig={'PageSize': 50, 'StartingToken': StartingToken},
-            StartTime=start_time
-        )
-        for page in page_iterator:
-            for event in page["Events"]:
-                print(f" {event['EventName']}  =>  {event}")
-                if event['EventName'] in ['BatchRevokePermissions', 'BatchGrantPermissions', 'CreateLFTag','DeleteLFTag', 'UpdateLFTag',
-                                          'GrantPermissions', 'RevokePermissions', 'CreateDatabase', 'DeleteDatabase','UpdateDatabase',
-                                          'CreateTable','BatchCreatePartition','UpdateTable','DeleteTable', 'RegisterResource','DeregisterResource', 'PutDataLakeSettings',
-                                          'AddLFTagsToResource','CreateDataCellsFilter'] and is_request_successful(event):
-
-                    print (f"Inserting record in DynamoDB table for event id {event['EventId']}")
-                    try:
-                        event['EventTime'] = event['EventTime'].strftime("%Y%m%d%H%M%S")
-                        event['Processed'] = 'N'
-                        response = lake_formation_table.put_item(
-                            Item=event,
-                            ConditionExpression='attribute_not_exists(EventId)'
-                        )
-                        print(response)
-                    except botocore.exceptions.ClientError as e:
-                        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
-                            print(e)
-                else:
-                    print(f"Skipping record insert in DynamoDB table for event id {event['EventId']}")
+    run_time = datetime.datetime.now(datetime.timezone.utc)
+    lookup_windows = {}
+    lookup_futures = {}
+    with ThreadPoolExecutor(max_workers=LOOKUP_WORKER_COUNT) as executor:
+        for attribte_value in replicated_events:
+            previous_end_time, seen_event_ids = get_cursor(attribte_value)
+            if previous_end_time is None:
+                start_time = run_time - datetime.timedelta(hours=LOOKUP_HOUR_DURATION)
+            else:
+                start_time = previous_end_time - datetime.timedelta(minutes=LOOKUP_OVERLAP_MINUTES)
+            # After an outage the backlog is caught up over several runs, at most the lookup duration per run
+            end_time = min(run_time, start_time + datetime.timedelta(hours=LOOKUP_HOUR_DURATION))
+            lookup_windows[attribte_value] = (end_time, seen_event_ids)
+            print(f"Attribute value {attribte_value} from {start_time} to {end_time}")
+            lookup_futures[attribte_value] = [executor.submit(lookup_events, lookup_attribute, slice_start, slice_end)
+                                              for lookup_attribute in get_lookup_attributes(attribte_value)
+                                              for slice_start, slice_end in get_time_slices(start_time, end_time)]
+
+    new_events = []
+    overlap_event_ids = {}
+    for attribte_value, futures in lookup_futures.items():
+        end_time, seen_event_ids = lookup_windows[attribte_value]
+        # Slices share their boundaries and EventName lookups also return other services, e.g. DynamoDB CreateTable
+        events = {event['EventId']: event for future in futures for event in future.result() if event['EventSource'] == attribte_value}
+        print(f"Looked up {len(events)} events of {attribte_value} with {len(futures)} concurrent lookups")
+        overlap_start_time = end_time - datetime.timedelta(minutes=LOOKUP_OVERLAP_MINUTES)
+        # The cap keeps the newest ids of the overlap
+        overlap_event_ids[attribte_value] = set([event['EventId'] for event in sorted(events.values(), key=lambda event: event['EventTime'], reverse=True)
+                                                 if event['EventTime'] >= overlap_start_time][:CURSOR_MAX_EVENT_IDS])
+        # Already stored by the previous run, read again because of the overlap
+        new_events.extend(event for event in events.values() if event['EventId'] not in seen_event_ids)
+
+    # Oldest first across both event sources, the replicate function replays the events in the order they are inserted
+    failed_event_sources = set()
+    for event in sorted(new_events, key=lambda event: event['EventTime']):
+        print(f" {event['EventName']}  =>  {event}")
+        if event['EventName'] in replicated_events[event['EventSource']] and is_request_successful(event):
+            print (f"Inserting record in DynamoDB table for event id {event['EventId']}")
+            try:
+                event['EventTime'] = event['EventTime'].strftime("%Y%m%d%H%M%S")
+                event['Processed'] = 'N'
+                response = lake_formation_table.put_item(
+                    Item=event,
+                    ConditionExpression='attribute_not_exists(EventId)'
+                )
+                print(response)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    print(e)
+                    failed_event_sources.add(event['EventSource'])
+        else:
+            print(f"Skipping record insert in DynamoDB table for event id {event['EventId']}")
+
+    for attribte_value, (end_time, _) in lookup_windows.items():
+        # Only moved once every event was stored, the window of a failed run is read again by the next one
+        if attribte_value in failed_event_sources:
+            print(f"Keeping the cursor of {attribte_value}, some events could not be stored")
+        else:
+            put_cursor(attribte_value, end_time, overlap_event_ids[attribte_value])
 
     return {
         'statusCode': 200,
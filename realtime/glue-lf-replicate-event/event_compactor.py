@@ -0,0 +1,61 @@
+from replay_scheduler import BARRIER, get_event_resources, is_conflicting
+
+# BatchCreatePartition accepts at most 100 partitions per call
+PARTITION_BATCH_SIZE = 100
+
+
+def merge_events(event, *absorbed_events):
+    """Returns event carrying the absorbed events, which are marked processed or failed together with it."""
+    merged_events = list(event.merged_events)
+    for absorbed_event in absorbed_events:
+        merged_events.extend([absorbed_event, *absorbed_event.merged_events])
+    return event._replace(merged_events=tuple(merged_events))
+
+
+def merge_partition_events(previous, event):
+    previous_partitions = previous.parameters['PartitionInputList']
+    partitions = event.parameters['PartitionInputList']
+    if previous.parameters.get('CatalogId') != event.parameters.get('CatalogId') \
+            or len(previous_partitions) + len(partitions) > PARTITION_BATCH_SIZE:
+        return None
+    return merge_events(event._replace(parameters={**event.parameters, 'PartitionInputList': previous_partitions + partitions}), previous)
+
+
+def compact_events(events):
+    """Collapses the redundant events of a table before they are replayed.
+
+    Only events with no other event on the table, its database or a grant on it in between are combined: consecutive
+    UpdateTable events keep the last one, an UpdateTable followed by a DeleteTable keeps the delete, a CreateTable
+    followed by its DeleteTable is dropped and consecutive BatchCreatePartition events are merged into calls of up to
+    100 partitions. Returns the events to replay and the events that need no replay."""
+    compacted = []
+    dropped = []
+    for event in sorted(events, key=lambda event: event.event_time):
+        resources = get_event_resources(event.event_name, event.parameters)
+        if resources is not BARRIER and event.event_name in ('UpdateTable', 'DeleteTable', 'BatchCreatePartition'):
+            while True:
+                previous_index = next((index for index in range(len(compacted) - 1, -1, -1)
+                                       if is_conflicting(resources, compacted[index][0])), None)
+                if previous_index is None or compacted[previous_index][0] != resources:
+                    break
+                previous = compacted[previous_index][1]
+                if event.event_name in ('UpdateTable', 'DeleteTable') and previous.event_name == 'UpdateTable':
+                    event = merge_events(event, previous)
+                elif event.event_name == 'DeleteTable' and previous.event_name == 'CreateTable':
+                    dropped.extend([event, *merge_events(event, previous).merged_events])
+                    event = None
+                elif event.event_name == 'BatchCreatePartition' and previous.event_name == 'BatchCreatePartition':
+                    merged_event = merge_partition_events(previous, event)
+                    if merged_event is None:
+                        break
+                    event = merged_event
+                else:
+                    break
+                del compacted[previous_index]
+                if event is None:
+                    break
+        if event is not None:
+            compacted.append((resources, event))
+    if len(compacted) < len(events):
+        print(f"Compacted {len(events)} events into {len(compacted)} replayed events, {len(dropped)} events need no replay")
+    return [event for _, event in compacted], dropped
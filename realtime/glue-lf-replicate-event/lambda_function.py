@@ -5,13 +5,12 @@ import os
 from configparser import ConfigParser
 from botocore.errorfactory import ClientError
 from cloudtrail_to_boto3 import cloudtail_to_boto3_converter
-from boto3.dynamodb.conditions import Key
-
-
-def get_s3_table_target_bucket_name(table_location):
-    s3_table_target_bucket_name = table_location.replace("s3://", "").split("/")[0]
-    s3_table_target_bucket_name = (s3_table_target_bucket_name[:-1] if s3_table_target_bucket_name.endswith('/') else s3_table_target_bucket_name)
-    return s3_table_target_bucket_name
+# Shared with the batch job, provided by the catalog_remapper layer
+from catalog_remapper import get_catalog_remapper
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+from replay_scheduler import ReplayEvent, ReplayFailed, get_batch_item_failures, is_replicated, replay_in_order
+from event_compactor import compact_events
 
 
 def get_config(s3_config_bucket,s3_config_file ):
@@ -27,13 +26,21 @@ config = get_config(config_file_bucket,config_file_key)
 SOURCE_REGION = config['AwsDataCatalog']['source_region']
 TARGET_REGION = config['AwsDataCatalog']['destination_region']
 table_s3_mapping = ast.literal_eval(config.get('AwsDataCatalog','S3BucketMapping'))
+# Bucket mappings apply to table, database and partition locations as well as registered resource ARNs
+catalog_remapper = get_catalog_remapper(config, table_s3_mapping)
+# Number of events on independent resources replayed at the same time
+REPLAY_WORKER_COUNT = config.getint('Performance', 'replay_worker_count', fallback=8)
+# Collapse the redundant table and partition events of a batch before they are replayed
+COMPACT_EVENTS = config.getboolean('Performance', 'compact_events', fallback=True)
 
 
 session = boto3.Session()
-dynamodb = boto3.resource('dynamodb', region_name=SOURCE_REGION)
+client_config = Config(max_pool_connections=max(REPLAY_WORKER_COUNT, 10), retries={'mode': 'adaptive', 'max_attempts': 10})
+# Clients are shared by the replay workers, unlike resources they are thread safe
+dynamodb_client = session.client('dynamodb', region_name=SOURCE_REGION, config=client_config)
 ct_client = session.client('cloudtrail', region_name=SOURCE_REGION)
-glue_client = session.client('glue', region_name=TARGET_REGION)
-lf_client = session.client('lakeformation', region_name=TARGET_REGION)
+glue_client = session.client('glue', region_name=TARGET_REGION, config=client_config)
+lf_client = session.client('lakeformation', region_name=TARGET_REGION, config=client_config)
 
 lake_formation_exceptions = lf_client.exceptions
 
@@ -42,283 +49,131 @@ InternalServiceException = lake_formation_exceptions.InternalServiceException
 InvalidInputException = lake_formation_exceptions.InvalidInputException
 OperationTimeoutException = lake_formation_exceptions.OperationTimeoutException
 
-table = dynamodb.Table("glue_lf_events")
+EVENTS_TABLE_NAME = "glue_lf_events"
+deserializer = TypeDeserializer()
 
 def event_processed(response, event_id):
-    if response is not None and response['ResponseMetadata']['HTTPStatusCode'] == 200 and not response.get('Failures',[]):
-        response = table.update_item(
-            Key={'EventId': event_id},
-            AttributeUpdates={
-                'Processed': {
-                    'Value': 'Y'
-                },
-            })
+    """Marks the event processed when the replayed call succeeded. A response of None means the change already
+    existed in the target region."""
+    if is_replicated(response):
+        response = dynamodb_client.update_item(
+            TableName=EVENTS_TABLE_NAME,
+            Key={'EventId': {'S': event_id}},
+            UpdateExpression='SET #processed = :processed',
+            ExpressionAttributeNames={'#processed': 'Processed'},
+            ExpressionAttributeValues={':processed': {'S': 'Y'}})
         print (f"Record for {event_id} updated to Y")
         return "Y"
     else:
         print (f"Error : Unable to update due to failure reason {response.get('Failures',[])}")
     return "N"
 
-def lambda_handler(event, context):
-    response = table.query(
-        IndexName='Processed-EventTime-index',
-        KeyConditionExpression=Key('Processed').eq('N')
-    )
+def prepare_table_input(boto3_parameters):
+    boto3_parameters['TableInput'].pop('isRowFilteringEnabled', None)
+    boto3_parameters['TableInput']['StorageDescriptor']['NumberOfBuckets'] = int(boto3_parameters['TableInput']['StorageDescriptor']['NumberOfBuckets'])
+    boto3_parameters['TableInput']['Retention'] = int(boto3_parameters['TableInput']['Retention'])
+
+def prepare_partition_input(boto3_parameters):
+    for partition_input in boto3_parameters['PartitionInputList']:
+        partition_input['StorageDescriptor']['NumberOfBuckets'] = int(partition_input['StorageDescriptor']['NumberOfBuckets'])
+
+def prepare_data_lake_settings(boto3_parameters):
+    boto3_parameters['DataLakeSettings'].pop('Parameters', None)
+    boto3_parameters['DataLakeSettings'].pop('whitelistedForExternalDataFiltering', None)
+    boto3_parameters['DataLakeSettings'].pop('disallowGrantOnIAMAllowedPrincipals', None)
+
+# Event name => client, operation, request clean up and the error codes meaning the change is already replicated
+replay_operations = {
+    'CreateDatabase': (glue_client, 'create_database', None, ['AlreadyExistsException']),
+    'UpdateDatabase': (glue_client, 'update_database', None, ['AlreadyExistsException', 'EntityNotFoundException']),
+    'DeleteDatabase': (glue_client, 'delete_database', None, ['AlreadyExistsException', 'EntityNotFoundException']),
+    'CreateTable': (glue_client, 'create_table', prepare_table_input, ['AlreadyExistsException']),
+    'UpdateTable': (glue_client, 'update_table', prepare_table_input, ['AlreadyExistsException']),
+    'DeleteTable': (glue_client, 'delete_table', None, ['AlreadyExistsException']),
+    'BatchCreatePartition': (glue_client, 'batch_create_partition', prepare_partition_input, ['AlreadyExistsException']),
+    'RegisterResource': (lf_client, 'register_resource', None, ['AlreadyExistsException']),
+    'DeregisterResource': (lf_client, 'deregister_resource', None, ['AlreadyExistsException']),
+    'PutDataLakeSettings': (lf_client, 'put_data_lake_settings', prepare_data_lake_settings, ['AccessDeniedException']),
+    'CreateLFTag': (lf_client, 'create_lf_tag', None, ['AccessDeniedException']),
+    'UpdateLFTag': (lf_client, 'update_lf_tag', None, ['AccessDeniedException']),
+    'DeleteLFTag': (lf_client, 'delete_lf_tag', None, ['AccessDeniedException']),
+    'AddLFTagsToResource': (lf_client, 'add_lf_tags_to_resource', None, ['AlreadyExistsException']),
+    'GrantPermissions': (lf_client, 'grant_permissions', None, ['EntityNotFoundException']),
+    'RevokePermissions': (lf_client, 'revoke_permissions', None, ['EntityNotFoundException', 'InvalidInputException']),
+    'BatchGrantPermissions': (lf_client, 'batch_grant_permissions', None, ['InvalidInputException']),
+    'BatchRevokePermissions': (lf_client, 'batch_revoke_permissions', None, ['InvalidInputException']),
+}
+
+def replay_event(event_name, boto3_parameters):
+    """Runs the target region call of one event. Returns None when the change already exists in the target region."""
+    client, operation_name, prepare_request, replicated_error_codes = replay_operations[event_name]
+    if prepare_request is not None:
+        prepare_request(boto3_parameters)
+    print (f"Running call with Boto3 Parameters {boto3_parameters}")
+    try:
+        return getattr(client, operation_name)(**boto3_parameters)
+    except ClientError as err:
+        if err.response['Error']['Code'] in replicated_error_codes:
+            print(f"{event_name} {err.response['Error']['Code']} exception, treating the event as replicated")
+            print(err)
+            return None
+        raise err
+
+def get_stream_item(record):
+    return {key: deserializer.deserialize(value) for key, value in record['dynamodb']['NewImage'].items()}
+
+def get_replay_event(item, sequence_number):
+    cloudtrail_event = json.loads(item['CloudTrailEvent'])['requestParameters']
+    print(f"{item['EventSource']} => {item['EventName']} => {cloudtrail_event}")
+    boto3_parameters = catalog_remapper.remap(cloudtail_to_boto3_converter(cloudtrail_event))
+    return ReplayEvent(item['EventId'], item['EventName'], item['EventTime'], sequence_number, boto3_parameters)
+
+def process_event(replay_event_data):
+    event_id = replay_event_data.event_id
+    print (f"Now processing event id {event_id} for event => {replay_event_data.event_name}")
+    response = replay_event(replay_event_data.event_name, replay_event_data.parameters)
+    record_processed_status = event_processed(response, event_id)
+    if record_processed_status == "Y":
+        for merged_event in replay_event_data.merged_events:
+            event_processed(None, merged_event.event_id)
+    print(f"Response for {event_id} => {response} with processed status {record_processed_status}")
+    if record_processed_status != "Y":
+        # Nothing re-scans unprocessed events, the record is only retried when the event is reported as failed
+        raise ReplayFailed(f"Replay of event id {event_id} failed with {response.get('Failures', [])}")
+    return record_processed_status
 
-    for k in response['Items']:
+def lambda_handler(event, context):
+    """Replays the events inserted in glue_lf_events from the stream records of the invocation.
+
+    Within the batch, events on independent resources are replayed concurrently and events on the same resource in
+    EventTime order. Across batches the order is the stream order, which is the oldest first insert order of the pull
+    function as far as DynamoDB Streams keeps it. The records of the failed events are reported and Lambda retries
+    the batch from the earliest of them."""
+    replay_events = []
+    batch_item_failures = []
+    for record in event['Records']:
+        if record['eventName'] != 'INSERT':
+            continue
+        item = get_stream_item(record)
+        if item.get('Processed') == 'Y':
+            continue
+        if item['EventName'] not in replay_operations:
+            print(f"Skipping event id {item['EventId']}, {item['EventName']} is not replicated")
+            continue
         try:
-            event_id = k['EventId']
-            print(f"Processing event id {event_id}")
-            response = table.get_item(
-                Key={
-                    'EventId': k['EventId']
-                },
-            )
-            event_name = response['Item']['EventName']
-            event_source = response['Item']['EventSource']
-            cw_request = json.loads(response['Item']['CloudTrailEvent'])
-            cloudtrail_event = cw_request['requestParameters']
-            print(f"{event_source} => {event_name} => {cloudtrail_event}")
-            boto3_parameters = cloudtail_to_boto3_converter(cloudtrail_event)
-            print (f"Running call with Boto3 Parameters {boto3_parameters}")
-            print (f"Now processing event id {event_id} for event => {event_name}")
-            response = None
-            record_processed_status = None
-            if event_name == 'CreateTable':
-                try:
-                    boto3_parameters['TableInput'].pop('isRowFilteringEnabled', None)
-                    boto3_parameters['TableInput']['StorageDescriptor']['NumberOfBuckets'] = int(boto3_parameters['TableInput']['StorageDescriptor']['NumberOfBuckets'])
-                    boto3_parameters['TableInput']['Retention'] = int(boto3_parameters['TableInput']['Retention'])
-                    s3_table_location = boto3_parameters['TableInput']['StorageDescriptor']['Location']
-                    s3_table_bucket_name = get_s3_table_target_bucket_name(s3_table_location)
-                    if s3_table_bucket_name in table_s3_mapping:
-                        s3_table_target_bucket_name = table_s3_mapping[s3_table_bucket_name]
-                        boto3_parameters['TableInput']['StorageDescriptor']['Location'] = boto3_parameters['TableInput']['StorageDescriptor']['Location'].replace(s3_table_bucket_name, s3_table_target_bucket_name)
-                    response = glue_client.create_table(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Table Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == "CreateDatabase":
-
-                try:
-                    response = glue_client.create_database(**boto3_parameters)
-                    print(f"Response for {event_id} => {response}")
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Database Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == "DeleteDatabase":
-                try:
-                    response = glue_client.delete_database(**boto3_parameters)
-                    print(f"Response for {event_id} => {response}")
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Database Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    elif err.response['Error']['Code'] == "EntityNotFoundException":
-                        print("Database does not exist")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == "UpdateDatabase":
-                try:
-                    response = glue_client.update_database(**boto3_parameters)
-                    print(f"Response for {event_id} => {response}")
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Database Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    elif err.response['Error']['Code'] == "EntityNotFoundException":
-                        print("Database does not exist")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == "UpdateTable":
-                try:
-                    boto3_parameters['TableInput'].pop('isRowFilteringEnabled', None)
-                    boto3_parameters['TableInput']['StorageDescriptor']['NumberOfBuckets'] = int(
-                    boto3_parameters['TableInput']['StorageDescriptor']['NumberOfBuckets'])
-                    boto3_parameters['TableInput']['Retention'] = int(boto3_parameters['TableInput']['Retention'])
-                    s3_table_location = boto3_parameters['TableInput']['StorageDescriptor']['Location']
-                    s3_table_bucket_name = get_s3_table_target_bucket_name(s3_table_location)
-                    if s3_table_bucket_name in table_s3_mapping:
-                        s3_table_target_bucket_name = table_s3_mapping[s3_table_bucket_name]
-                        boto3_parameters['TableInput']['StorageDescriptor']['Location'] = boto3_parameters['TableInput']['StorageDescriptor']['Location'].replace(s3_table_bucket_name, s3_table_target_bucket_name)
-                    response = glue_client.update_table(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Database Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == "DeleteTable":
-                try:
-                    response = glue_client.delete_table(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Table Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'RegisterResource':
-                try:
-                    response = lf_client.register_resource(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Database Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'DeregisterResource':
-                try:
-                    response = lf_client.deregister_resource(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Database Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'PutDataLakeSettings':
-                try:
-                    boto3_parameters['DataLakeSettings'].pop('Parameters', None)
-                    boto3_parameters['DataLakeSettings'].pop('whitelistedForExternalDataFiltering', None)
-                    boto3_parameters['DataLakeSettings'].pop('disallowGrantOnIAMAllowedPrincipals', None)
-                    response = lf_client.put_data_lake_settings(**boto3_parameters)
-                    print(f"Response for {event_id} => {response}")
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AccessDeniedException":
-                        print("PutDataLakeSettings AccessDeniedException exception occurred")
-                        print(err)
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'CreateLFTag':
-                print("CreateLFTag LF event:")
-                try:
-                    response = lf_client.create_lf_tag(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    print(err)
-                    if err.response['Error']['Code'] == "AccessDeniedException":
-                        print("CreateLFTag AccessDeniedException exception")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'DeleteLFTag':
-                print("DeleteLFTag LF event:")
-                try:
-                    response = lf_client.delete_lf_tag(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AccessDeniedException":
-                        print("DeleteLFTag AccessDeniedException exception")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'UpdateLFTag':
-                try:
-                    response = lf_client.update_lf_tag(**boto3_parameters)
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AccessDeniedException":
-                        print("UpdateLFTag AccessDeniedException exception")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'AddLFTagsToResource':
-                try:
-                    response = lf_client.add_lf_tags_to_resource(**boto3_parameters)
-                    print (f"Response for {event_id} => {response}")
-                    record_processed_status = event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Database Already Exists")
-                        record_processed_status = event_processed(response, k['EventId'])
-                    else:
-                        raise err
-
-            elif event_name == 'BatchGrantPermissions':
-                try:
-                    print(boto3_parameters)
-                    response = lf_client.batch_grant_permissions(**boto3_parameters)
-                    print(response)
-                    event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "InvalidInputException":
-                        print("BatchGrantPermissions InvalidInputException occurred!")
-                        event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'BatchRevokePermissions':
-                try:
-                    print(boto3_parameters)
-                    response = lf_client.batch_revoke_permissions(**boto3_parameters)
-                    print(response)
-                    event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "InvalidInputException":
-                        print("BatchRevokePermissions InvalidInputException occurred!")
-                        event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'RevokePermissions':
-                try:
-                    response = lf_client.revoke_permissions(**boto3_parameters)
-                    print(response)
-                    event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "EntityNotFoundException":
-                        print("RevokePermissions EntityNotFoundException exception")
-                        event_processed(response, k['EventId'])
-                    elif err.response['Error']['Code'] == "InvalidInputException":
-                        print(err)
-                        event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'GrantPermissions':
-                try:
-                    response = lf_client.grant_permissions(**boto3_parameters)
-                    event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "EntityNotFoundException":
-                        print("GrantPermissions EntityNotFoundException exception")
-                        event_processed(response, k['EventId'])
-                    else:
-                        raise err
-            elif event_name == 'BatchCreatePartition':
-                boto3_parameters['PartitionInputList'][0]['StorageDescriptor']['NumberOfBuckets'] = int(
-                    boto3_parameters['PartitionInputList'][0]['StorageDescriptor']['NumberOfBuckets'])
-                print(boto3_parameters)
-                try:
-                    response = glue_client.batch_create_partition(**boto3_parameters)
-                    event_processed(response, k['EventId'])
-                except ClientError as err:
-                    if err.response['Error']['Code'] == "AlreadyExistsException":
-                        print("Partitions Already Exists")
-                        event_processed(response, k['EventId'])
-                    else:
-                        raise err
-
-            print(f"Response for {event_id} => {response} with processed status {record_processed_status}")
+            print(f"Processing event id {item['EventId']}")
+            replay_events.append(get_replay_event(item, record['dynamodb']['SequenceNumber']))
         except Exception as e:
-            print (f"Received exception {e}")
-
+            print (f"Received exception {e} for event id {item['EventId']}")
+            batch_item_failures.append({'itemIdentifier': record['dynamodb']['SequenceNumber']})
+
+    if COMPACT_EVENTS:
+        replay_events, dropped_events = compact_events(replay_events)
+        for dropped_event in dropped_events:
+            event_processed(None, dropped_event.event_id)
+    failed_events = replay_in_order(replay_events, process_event, REPLAY_WORKER_COUNT)
+    batch_item_failures.extend(get_batch_item_failures(failed_events))
+    print(f"Replayed {len(replay_events) - len(failed_events)} of {len(replay_events)} events")
     return {
-        'body': json.dumps('Process completed!')
+        'batchItemFailures': batch_item_failures
     }
-
-
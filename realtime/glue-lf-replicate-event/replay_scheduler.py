@@ -0,0 +1,135 @@
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# merged_events are the events a compacted event stands for, they are replayed, marked and reported with it
+ReplayEvent = namedtuple('ReplayEvent', ['event_id', 'event_name', 'event_time', 'sequence_number', 'parameters', 'merged_events'],
+                         defaults=[()])
+
+# Events changing the whole catalog or the data lake settings, replayed after every earlier event and before every later one
+BARRIER = None
+
+
+class DependencyFailed(Exception):
+    """An earlier event on the same resource failed, so the event is not replayed out of order."""
+
+
+class ReplayFailed(Exception):
+    """The replayed call returned a response reporting failures, so the event is left unprocessed."""
+
+
+def is_replicated(response):
+    """Whether the response of a replayed call means the change is in the target region. None means it already was."""
+    return response is None or (response['ResponseMetadata']['HTTPStatusCode'] == 200 and not response.get('Failures', []))
+
+
+def get_batch_item_failures(failed_events):
+    """Stream records to report for the failed events, including the records of the events merged into them."""
+    return [{'itemIdentifier': event.sequence_number}
+            for failed_event in failed_events for event in (failed_event, *failed_event.merged_events)]
+
+
+def get_catalog_resource(database_name, table_name=None):
+    # Glue stores database and table names in lower case
+    if table_name is None:
+        return 'catalog', database_name.lower()
+    return 'catalog', database_name.lower(), table_name.lower()
+
+
+def get_permission_resources(resource):
+    """Resource paths of the Resource of a grant or revoke request."""
+    if 'Database' in resource:
+        return [get_catalog_resource(resource['Database']['Name'])]
+    for table_key in ('Table', 'TableWithColumns'):
+        if table_key in resource:
+            table = resource[table_key]
+            return [get_catalog_resource(table['DatabaseName'], table.get('Name'))]
+    if 'DataCellsFilter' in resource:
+        return [get_catalog_resource(resource['DataCellsFilter']['DatabaseName'], resource['DataCellsFilter']['TableName'])]
+    if 'DataLocation' in resource:
+        return [('location', resource['DataLocation']['ResourceArn'])]
+    if 'LFTag' in resource:
+        return [('lf_tag', resource['LFTag']['TagKey'])]
+    if 'LFTagPolicy' in resource:
+        return [('lf_tag', tag['TagKey']) for tag in resource['LFTagPolicy']['Expression']]
+    return BARRIER
+
+
+def get_event_resources(event_name, parameters):
+    """Returns the resource paths an event changes, or BARRIER when it cannot be narrowed down to resources.
+
+    Paths are tuples and two events conflict when a path of one is a prefix of a path of the other, e.g. a database
+    event conflicts with the events of its tables."""
+    try:
+        if event_name in ('CreateDatabase', 'UpdateDatabase'):
+            name = parameters['DatabaseInput']['Name'] if event_name == 'CreateDatabase' else parameters['Name']
+            return [get_catalog_resource(name)]
+        if event_name == 'DeleteDatabase':
+            return [get_catalog_resource(parameters['Name'])]
+        if event_name in ('CreateTable', 'UpdateTable'):
+            return [get_catalog_resource(parameters['DatabaseName'], parameters['TableInput']['Name'])]
+        if event_name == 'DeleteTable':
+            return [get_catalog_resource(parameters['DatabaseName'], parameters['Name'])]
+        if event_name == 'BatchCreatePartition':
+            return [get_catalog_resource(parameters['DatabaseName'], parameters['TableName'])]
+        if event_name in ('RegisterResource', 'DeregisterResource'):
+            return [('location', parameters['ResourceArn'])]
+        if event_name in ('CreateLFTag', 'UpdateLFTag', 'DeleteLFTag'):
+            return [('lf_tag', parameters['TagKey'])]
+        if event_name == 'AddLFTagsToResource':
+            resources = get_permission_resources(parameters['Resource'])
+            if resources is BARRIER:
+                return BARRIER
+            return resources + [('lf_tag', tag['TagKey']) for tag in parameters['LFTags']]
+        if event_name in ('GrantPermissions', 'RevokePermissions'):
+            return get_permission_resources(parameters['Resource'])
+        if event_name in ('BatchGrantPermissions', 'BatchRevokePermissions'):
+            resources = [get_permission_resources(entry['Resource']) for entry in parameters['Entries']]
+            return BARRIER if BARRIER in resources else [resource for entry_resources in resources for resource in entry_resources]
+    except KeyError:
+        pass
+    return BARRIER
+
+
+def is_conflicting(resources, other_resources):
+    if resources is BARRIER or other_resources is BARRIER:
+        return True
+    return any(resource[:len(other_resource)] == other_resource or other_resource[:len(resource)] == resource
+               for resource in resources for other_resource in other_resources)
+
+
+def replay_in_order(events, replay, worker_count=8):
+    """Replays the events of one batch concurrently while keeping the EventTime order of the events on the same resource.
+
+    Events are sorted by EventTime, the sort is stable so events of the same second keep the order they were given
+    in. Every event waits for the earlier events it conflicts with. Events are submitted in order to a FIFO pool, so
+    an event only ever waits for events that are already running. replay raises for an event that was not replayed.
+    Returns the failed events, including the events skipped because an event they depend on failed."""
+    events = sorted(events, key=lambda event: event.event_time)
+    scheduled = []
+    failed = []
+    failed_lock = threading.Lock()
+
+    def run(event, dependencies):
+        for dependency in dependencies:
+            if dependency.exception() is not None:
+                raise DependencyFailed(f"Skipping event id {event.event_id}, an earlier event on the same resource failed")
+        return replay(event)
+
+    def record_failure(event, future):
+        if future.exception() is not None:
+            print(f"Received exception {future.exception()} for event id {event.event_id}")
+            with failed_lock:
+                failed.append(event)
+
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        for event in events:
+            resources = get_event_resources(event.event_name, event.parameters)
+            dependencies = [future for other_resources, future in scheduled if is_conflicting(resources, other_resources)]
+            future = executor.submit(run, event, dependencies)
+            future.add_done_callback(lambda future, event=event: record_failure(event, future))
+            scheduled.append((resources, future))
+            if resources is BARRIER:
+                # Later events only need to wait for the barrier, it already waited for everything before it
+                scheduled = [(resources, future)]
+    return failed
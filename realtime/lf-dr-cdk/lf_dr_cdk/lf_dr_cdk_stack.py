@@ -72,6 +72,19 @@ class LfDrCdkStack(Stack):
             projection_type = dynamodb.ProjectionType.KEYS_ONLY,
         )
 
+        # Per event source end of the last CloudTrail lookup window, read by the next run of the pull function
+        cursor_table = dynamodb.Table(
+            self, "glue_lf_cloudtrail_cursor",
+            table_name="glue_lf_cloudtrail_cursor",
+            partition_key=dynamodb.Attribute(
+                name="EventSource",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
+            encryption=dynamodb.TableEncryption.AWS_MANAGED,
+        )
+
         # table.add_global_secondary_index()
         lambda_role = iam.Role(self, "lf-dr-glue-lambda-iam",
                                role_name="glue-lambda-iam",
@@ -252,6 +265,15 @@ class LfDrCdkStack(Stack):
         )
         rule.add_target(targets.LambdaFunction(glue_lf_cloudtrail_pull_new))
 
+        # Remapping module shared with the batch Glue job, the layer directory holds it below python/
+        catalog_remapper_layer = lambda_.LayerVersion(
+            self,
+            "catalog_remapper_layer",
+            code=lambda_.Code.from_asset("./../../common"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+            description="Catalog remapping module shared by the Lake Formation DR batch job and replicate Lambda function"
+        )
+
         glue_lf_replicate_event = lambda_.Function(
             self,
             "glue_lf_replicate_event_lambda",
@@ -261,6 +283,7 @@ class LfDrCdkStack(Stack):
             timeout=Duration.seconds(900),
             runtime=lambda_.Runtime.PYTHON_3_9,
             role=lambda_role,
+            layers=[catalog_remapper_layer],
             environment={
                 "config_file_bucket": self.node.try_get_context("config_file_bucket"),
                 "config_file_key": self.node.try_get_context("config_file_key"),
@@ -268,15 +291,20 @@ class LfDrCdkStack(Stack):
         )
 
         dead_letter_queue = sqs.Queue(self, "lfDRDeadLetterQueue")
+        # Only inserts carry new events, the updates marking an event processed are filtered out of the stream.
+        # The handler reports the first failed record so that Lambda retries the batch from there.
         glue_lf_replicate_event.add_event_source(DynamoEventSource(table,
                                               starting_position=lambda_.StartingPosition.TRIM_HORIZON,
-                                              batch_size=1,
+                                              batch_size=int(self.node.try_get_context("replicate_batch_size") or 100),
                                               bisect_batch_on_error=True,
+                                              report_batch_item_failures=True,
+                                              filters=[lambda_.FilterCriteria.filter({"eventName": lambda_.FilterRule.is_equal("INSERT")})],
                                               on_failure=SqsDlq(dead_letter_queue),
-                                              retry_attempts=0
+                                              retry_attempts=int(self.node.try_get_context("replicate_retry_attempts") or 2)
                                               ))
 
         table.grant_read_write_data(glue_lf_cloudtrail_pull_new)
+        cursor_table.grant_read_write_data(glue_lf_cloudtrail_pull_new)
         table.grant_read_write_data(glue_lf_replicate_event)
         glue_lf_cloudtrail_pull_new.add_environment('TABLE_NAME', table.table_name)
         self.lambda_role_arn = lambda_role.role_arn
\ No newline at end of file
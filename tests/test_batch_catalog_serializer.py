@@ -0,0 +1,45 @@
+import copy
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'batch', 'script'))
+from catalog_serializer import decode_partition_delta, encode_partition_delta
+
+TABLE_STORAGE_DESCRIPTOR = {
+    'Columns': [{'Name': 'id', 'Type': 'bigint'}],
+    'Location': 's3://my-bucket/warehouse/sales',
+    'InputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
+    'SerdeInfo': {'SerializationLibrary': 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'},
+    'Compressed': False,
+}
+
+
+class TestPartitionDelta(unittest.TestCase):
+
+    def assert_round_trip(self, partition):
+        encoded = encode_partition_delta(copy.deepcopy(partition), copy.deepcopy(TABLE_STORAGE_DESCRIPTOR))
+        self.assertEqual(decode_partition_delta(encoded, copy.deepcopy(TABLE_STORAGE_DESCRIPTOR)), partition)
+
+    def test_location_below_table_location(self):
+        storage_descriptor = dict(TABLE_STORAGE_DESCRIPTOR, Location='s3://my-bucket/warehouse/sales/dt=2024-01-01')
+        partition = {'Values': ['2024-01-01'], 'StorageDescriptor': storage_descriptor}
+        encoded = encode_partition_delta(copy.deepcopy(partition), TABLE_STORAGE_DESCRIPTOR)
+        self.assertEqual(encoded['LocationSuffix'], 'dt=2024-01-01')
+        self.assertEqual(encoded['StorageDescriptorDelta'], {})
+        self.assert_round_trip(partition)
+
+    def test_location_outside_table_location(self):
+        storage_descriptor = dict(TABLE_STORAGE_DESCRIPTOR, Location='s3://other-bucket/sales/dt=2024-01-01', Compressed=True)
+        self.assert_round_trip({'Values': ['2024-01-01'], 'StorageDescriptor': storage_descriptor})
+
+    def test_removed_keys(self):
+        storage_descriptor = {key: value for key, value in TABLE_STORAGE_DESCRIPTOR.items() if key not in ('SerdeInfo', 'Compressed')}
+        storage_descriptor['Location'] = 's3://my-bucket/warehouse/sales/dt=2024-01-02'
+        self.assert_round_trip({'Values': ['2024-01-02'], 'StorageDescriptor': storage_descriptor})
+
+    def test_missing_storage_descriptor(self):
+        self.assert_round_trip({'Values': ['2024-01-03'], 'Parameters': {'numRows': '10'}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'batch', 'script'))
+from catalog_serializer import get_permission_changes, get_permission_entries, get_permission_keys
+
+PRINCIPAL = {'DataLakePrincipalIdentifier': 'arn:aws:iam::111111111111:role/analyst'}
+
+
+class TestPermissionKeys(unittest.TestCase):
+
+    def test_all_tables_becomes_table_wildcard(self):
+        row = {'Principal': PRINCIPAL, 'Resource': {'Table': {'CatalogId': '111111111111', 'DatabaseName': 'sales', 'Name': 'ALL_TABLES'}},
+               'Permissions': ['SELECT'], 'PermissionsWithGrantOption': []}
+        [(_, _, permission, grantable)] = get_permission_keys(row)
+        [entry] = get_permission_entries(get_permission_keys(row))
+        self.assertEqual((permission, grantable), ('SELECT', False))
+        self.assertEqual(entry['Resource'], {'Table': {'CatalogId': '111111111111', 'DatabaseName': 'sales', 'TableWildcard': {}}})
+
+    def test_table_with_columns_wildcard_becomes_table_wildcard(self):
+        row = {'Principal': PRINCIPAL,
+               'Resource': {'TableWithColumns': {'CatalogId': '111111111111', 'DatabaseName': 'sales', 'Name': 'ALL_TABLES',
+                                                 'ColumnWildcard': {}}},
+               'Permissions': ['SELECT'], 'PermissionsWithGrantOption': ['SELECT']}
+        table_row = {'Principal': PRINCIPAL, 'Resource': {'Table': {'CatalogId': '111111111111', 'DatabaseName': 'sales', 'TableWildcard': {}}},
+                     'Permissions': ['SELECT'], 'PermissionsWithGrantOption': ['SELECT']}
+        self.assertEqual(get_permission_keys(row), get_permission_keys(table_row))
+        [entry] = get_permission_entries(get_permission_keys(row))
+        self.assertEqual(entry['Resource'], {'Table': {'CatalogId': '111111111111', 'DatabaseName': 'sales', 'TableWildcard': {}}})
+        self.assertEqual(entry['PermissionsWithGrantOption'], ['SELECT'])
+
+    def test_grant_option_change_is_revoked_and_granted(self):
+        resource = {'Table': {'DatabaseName': 'sales', 'Name': 'orders'}}
+        source_keys = get_permission_keys({'Principal': PRINCIPAL, 'Resource': dict(resource), 'Permissions': ['SELECT', 'DESCRIBE'],
+                                           'PermissionsWithGrantOption': ['SELECT']})
+        target_keys = get_permission_keys({'Principal': PRINCIPAL, 'Resource': dict(resource), 'Permissions': ['SELECT', 'DESCRIBE'],
+                                           'PermissionsWithGrantOption': []})
+        grant_entries, revoke_entries = get_permission_changes(source_keys, target_keys, revoke_extra_permissions=True)
+        self.assertEqual(grant_entries, [{'Principal': PRINCIPAL, 'Resource': resource, 'Permissions': ['SELECT'],
+                                          'PermissionsWithGrantOption': ['SELECT']}])
+        self.assertEqual(revoke_entries, [{'Principal': PRINCIPAL, 'Resource': resource, 'Permissions': ['SELECT'],
+                                           'PermissionsWithGrantOption': []}])
+        self.assertEqual(get_permission_changes(source_keys, target_keys)[1], [])
+        self.assertEqual(get_permission_changes(source_keys, source_keys, revoke_extra_permissions=True), ([], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common', 'python'))
+from catalog_remapper import CatalogRemapper, LocationMapper
+
+
+class TestLocationMapper(unittest.TestCase):
+
+    def test_bucket_mapping(self):
+        location_mapper = LocationMapper({'my-bucket': 'my-bucket-dr', 'my.bucket.name.with.dots': 'dr.bucket'})
+        test_cases = [
+            ("s3://my-bucket/path/to/data", "s3://my-bucket-dr/path/to/data"),
+            ("s3://my-bucket-name/path/to/data/", "s3://my-bucket-name/path/to/data/"),
+            ("s3://my.bucket.name.with.dots/path/to/data", "s3://dr.bucket/path/to/data"),
+            ("arn:aws:s3:::my-bucket/path", "arn:aws:s3:::my-bucket-dr/path"),
+        ]
+        for location, expected_location in test_cases:
+            self.assertEqual(location_mapper.map(location), expected_location)
+
+    def test_longest_prefix_wins(self):
+        location_mapper = LocationMapper({'my-bucket': 'bucket-dr', 'my-bucket/warehouse/sales': 'sales-dr/sales'})
+        self.assertEqual(location_mapper.map("s3://my-bucket/warehouse/sales/dt=1"), "s3://sales-dr/sales/dt=1")
+        self.assertEqual(location_mapper.map("s3://my-bucket/warehouse/salesforce"), "s3://bucket-dr/warehouse/salesforce")
+
+
+class TestCatalogRemapper(unittest.TestCase):
+
+    def test_remap(self):
+        remapper = CatalogRemapper({'111111111111': '222222222222'}, {'arn:aws:iam::111111111111:role/admin': 'arn:aws:iam::222222222222:role/dr-admin'},
+                                   {'my-bucket': 'my-bucket-dr'})
+        request = {
+            'CatalogId': '111111111111',
+            'Entries': [{'Principal': {'DataLakePrincipalIdentifier': 'arn:aws:iam::111111111111:role/admin'}},
+                        {'Principal': {'DataLakePrincipalIdentifier': 'arn:aws:iam::111111111111:role/analyst'}}],
+            'TableInput': {'StorageDescriptor': {'Location': 's3://my-bucket/sales'}},
+        }
+        self.assertEqual(remapper.remap(request), {
+            'CatalogId': '222222222222',
+            'Entries': [{'Principal': {'DataLakePrincipalIdentifier': 'arn:aws:iam::222222222222:role/dr-admin'}},
+                        {'Principal': {'DataLakePrincipalIdentifier': 'arn:aws:iam::222222222222:role/analyst'}}],
+            'TableInput': {'StorageDescriptor': {'Location': 's3://my-bucket-dr/sales'}},
+        })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'realtime', 'glue-lf-replicate-event'))
+from event_compactor import compact_events
+from replay_scheduler import ReplayEvent
+
+
+def table_event(event_id, event_name, event_time, table_name='orders'):
+    if event_name == 'DeleteTable':
+        parameters = {'DatabaseName': 'sales', 'Name': table_name}
+    else:
+        parameters = {'DatabaseName': 'sales', 'TableInput': {'Name': table_name}}
+    return ReplayEvent(event_id, event_name, event_time, f"seq-{event_id}", parameters)
+
+
+def partition_event(event_id, event_time, partition_count):
+    partitions = [{'Values': [f"{event_id}-{index}"]} for index in range(partition_count)]
+    parameters = {'DatabaseName': 'sales', 'TableName': 'orders', 'PartitionInputList': partitions}
+    return ReplayEvent(event_id, 'BatchCreatePartition', event_time, f"seq-{event_id}", parameters)
+
+
+def event_ids(events):
+    return [event.event_id for event in events]
+
+
+class TestCompactEvents(unittest.TestCase):
+
+    def test_update_then_update_keeps_the_last_one(self):
+        compacted, dropped = compact_events([table_event('first', 'UpdateTable', '2024-01-01T00:00:00Z'),
+                                             table_event('second', 'UpdateTable', '2024-01-01T00:00:01Z')])
+        self.assertEqual(event_ids(compacted), ['second'])
+        self.assertEqual(event_ids(compacted[0].merged_events), ['first'])
+        self.assertEqual(dropped, [])
+
+    def test_update_then_delete_keeps_the_delete(self):
+        compacted, dropped = compact_events([table_event('update', 'UpdateTable', '2024-01-01T00:00:00Z'),
+                                             table_event('delete', 'DeleteTable', '2024-01-01T00:00:01Z')])
+        self.assertEqual(event_ids(compacted), ['delete'])
+        self.assertEqual(event_ids(compacted[0].merged_events), ['update'])
+        self.assertEqual(dropped, [])
+
+    def test_create_update_delete_is_dropped(self):
+        compacted, dropped = compact_events([table_event('create', 'CreateTable', '2024-01-01T00:00:00Z'),
+                                             table_event('update', 'UpdateTable', '2024-01-01T00:00:01Z'),
+                                             table_event('delete', 'DeleteTable', '2024-01-01T00:00:02Z')])
+        self.assertEqual(compacted, [])
+        self.assertEqual(sorted(event_ids(dropped)), ['create', 'delete', 'update'])
+
+    def test_partition_merges_stay_within_100_partitions(self):
+        compacted, dropped = compact_events([partition_event('first', '2024-01-01T00:00:00Z', 60),
+                                             partition_event('second', '2024-01-01T00:00:01Z', 30),
+                                             partition_event('third', '2024-01-01T00:00:02Z', 30)])
+        self.assertEqual([len(event.parameters['PartitionInputList']) for event in compacted], [90, 30])
+        self.assertEqual(event_ids(compacted), ['second', 'third'])
+        self.assertEqual(event_ids(compacted[0].merged_events), ['first'])
+        self.assertEqual(compacted[0].parameters['PartitionInputList'][0]['Values'], ['first-0'])
+        self.assertEqual(dropped, [])
+
+    def test_database_event_in_between_blocks_merging(self):
+        database_event = ReplayEvent('database', 'UpdateDatabase', '2024-01-01T00:00:01Z', 'seq-database',
+                                     {'Name': 'sales', 'DatabaseInput': {'Name': 'sales'}})
+        compacted, _ = compact_events([table_event('first', 'UpdateTable', '2024-01-01T00:00:00Z'), database_event,
+                                       table_event('second', 'UpdateTable', '2024-01-01T00:00:02Z')])
+        self.assertEqual(event_ids(compacted), ['first', 'database', 'second'])
+
+    def test_grant_in_between_blocks_merging(self):
+        grant_event = ReplayEvent('grant', 'GrantPermissions', '2024-01-01T00:00:01Z', 'seq-grant',
+                                  {'Resource': {'Table': {'DatabaseName': 'sales', 'Name': 'orders'}}})
+        compacted, dropped = compact_events([table_event('create', 'CreateTable', '2024-01-01T00:00:00Z'), grant_event,
+                                             table_event('delete', 'DeleteTable', '2024-01-01T00:00:02Z')])
+        self.assertEqual(event_ids(compacted), ['create', 'grant', 'delete'])
+        self.assertEqual(dropped, [])
+
+    def test_other_tables_do_not_block_merging(self):
+        compacted, _ = compact_events([table_event('first', 'UpdateTable', '2024-01-01T00:00:00Z'),
+                                       table_event('other', 'UpdateTable', '2024-01-01T00:00:01Z', 'customers'),
+                                       table_event('second', 'UpdateTable', '2024-01-01T00:00:02Z')])
+        self.assertEqual(event_ids(compacted), ['other', 'second'])
+
+
+if __name__ == '__main__':
+    unittest.main()
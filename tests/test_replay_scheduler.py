@@ -0,0 +1,119 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'realtime', 'glue-lf-replicate-event'))
+from replay_scheduler import BARRIER, ReplayEvent, ReplayFailed, get_batch_item_failures, get_event_resources, is_conflicting, is_replicated, replay_in_order
+
+
+def grant_event(event_id, event_time, database_name, table_name, merged_events=()):
+    parameters = {'Entries': [{'Id': '1', 'Resource': {'Table': {'DatabaseName': database_name, 'Name': table_name}}}]}
+    return ReplayEvent(event_id, 'BatchGrantPermissions', event_time, f"seq-{event_id}", parameters, merged_events)
+
+
+def update_table_event(event_id, event_time, database_name, table_name):
+    parameters = {'DatabaseName': database_name, 'TableInput': {'Name': table_name}}
+    return ReplayEvent(event_id, 'UpdateTable', event_time, f"seq-{event_id}", parameters)
+
+
+class TestEventResources(unittest.TestCase):
+
+    def test_database_conflicts_with_its_tables(self):
+        database_resources = get_event_resources('UpdateDatabase', {'Name': 'Sales'})
+        table_resources = get_event_resources('UpdateTable', {'DatabaseName': 'sales', 'TableInput': {'Name': 'orders'}})
+        other_resources = get_event_resources('UpdateTable', {'DatabaseName': 'sales_archive', 'TableInput': {'Name': 'orders'}})
+        self.assertTrue(is_conflicting(database_resources, table_resources))
+        self.assertFalse(is_conflicting(table_resources, other_resources))
+        self.assertFalse(is_conflicting(database_resources, other_resources))
+
+    def test_unknown_event_is_a_barrier(self):
+        self.assertIs(get_event_resources('PutDataLakeSettings', {'DataLakeSettings': {}}), BARRIER)
+        self.assertIs(get_event_resources('UpdateTable', {'DatabaseName': 'sales'}), BARRIER)
+
+
+class TestReplayInOrder(unittest.TestCase):
+
+    def test_same_table_events_run_in_event_time_order(self):
+        events = [update_table_event(str(index), f"2024-01-01T00:00:{index:02d}Z", 'sales', 'orders') for index in range(10)]
+        replayed = []
+
+        def replay(event):
+            # Later events finish first unless they wait for the earlier ones
+            time.sleep(0.001 * (10 - int(event.event_id)))
+            replayed.append(event.event_id)
+
+        self.assertEqual(replay_in_order(list(reversed(events)), replay, worker_count=4), [])
+        self.assertEqual(replayed, [event.event_id for event in events])
+
+    def test_independent_tables_run_concurrently(self):
+        events = [update_table_event('orders', '2024-01-01T00:00:00Z', 'sales', 'orders'),
+                  update_table_event('customers', '2024-01-01T00:00:01Z', 'sales', 'customers')]
+        # Both replays have to be running at the same time to pass the barrier
+        both_running = threading.Barrier(2, timeout=5)
+        self.assertEqual(replay_in_order(events, lambda event: both_running.wait(), worker_count=2), [])
+
+    def test_failed_event_skips_later_events_on_its_resource(self):
+        events = [update_table_event('failing', '2024-01-01T00:00:00Z', 'sales', 'orders'),
+                  update_table_event('same_table', '2024-01-01T00:00:01Z', 'sales', 'orders'),
+                  update_table_event('other_table', '2024-01-01T00:00:02Z', 'sales', 'customers')]
+        replayed = []
+
+        def replay(event):
+            if event.event_id == 'failing':
+                raise RuntimeError("replay failed")
+            replayed.append(event.event_id)
+
+        failed_events = replay_in_order(events, replay)
+        self.assertEqual({event.event_id for event in failed_events}, {'failing', 'same_table'})
+        self.assertEqual(replayed, ['other_table'])
+
+    def test_barrier_waits_for_every_earlier_event(self):
+        events = [update_table_event('orders', '2024-01-01T00:00:00Z', 'sales', 'orders'),
+                  update_table_event('customers', '2024-01-01T00:00:01Z', 'marketing', 'customers'),
+                  ReplayEvent('settings', 'PutDataLakeSettings', '2024-01-01T00:00:02Z', 'seq-settings', {'DataLakeSettings': {}}),
+                  update_table_event('after', '2024-01-01T00:00:03Z', 'finance', 'ledger')]
+        replayed = []
+        lock = threading.Lock()
+
+        def replay(event):
+            if event.event_id in ('orders', 'customers'):
+                time.sleep(0.05)
+            with lock:
+                replayed.append(event.event_id)
+
+        self.assertEqual(replay_in_order(events, replay, worker_count=4), [])
+        self.assertEqual(sorted(replayed[:2]), ['customers', 'orders'])
+        self.assertEqual(replayed[2:], ['settings', 'after'])
+
+
+class TestReplayFailures(unittest.TestCase):
+
+    def test_response_with_failures_is_reported(self):
+        failures_response = {'ResponseMetadata': {'HTTPStatusCode': 200},
+                             'Failures': [{'RequestEntry': {'Id': '1'}, 'Error': {'ErrorCode': 'ConcurrentModificationException'}}]}
+        self.assertFalse(is_replicated(failures_response))
+        self.assertFalse(is_replicated({'ResponseMetadata': {'HTTPStatusCode': 500}}))
+        self.assertTrue(is_replicated({'ResponseMetadata': {'HTTPStatusCode': 200}, 'Failures': []}))
+        self.assertTrue(is_replicated(None))
+
+        merged_event = grant_event('merged', '2024-01-01T00:00:00Z', 'sales', 'orders')
+        failing_event = grant_event('grant', '2024-01-01T00:00:01Z', 'sales', 'orders', (merged_event,))
+        later_event = grant_event('later', '2024-01-01T00:00:02Z', 'sales', 'orders')
+        replayed = []
+
+        def replay(event):
+            if event.event_id == 'grant' and not is_replicated(failures_response):
+                raise ReplayFailed(f"Replay of event id {event.event_id} failed")
+            replayed.append(event.event_id)
+
+        failed_events = replay_in_order([failing_event, later_event], replay)
+        self.assertEqual(replayed, [])
+        self.assertEqual({event.event_id for event in failed_events}, {'grant', 'later'})
+        self.assertEqual(sorted(failure['itemIdentifier'] for failure in get_batch_item_failures(failed_events)),
+                         ['seq-grant', 'seq-later', 'seq-merged'])
+
+
+if __name__ == '__main__':
+    unittest.main()